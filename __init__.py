@@ -13,6 +13,7 @@ bl_info = {
 import bpy
 import bmesh
 import time
+import json
 import importlib
 from . import blockBuilder
 importlib.reload(blockBuilder)
@@ -79,6 +80,33 @@ bpy.types.Object.swiftBlock_useNumba = bpy.props.BoolProperty(
     description="Option to Use Python Numba Performance Library (Must be Installed Separately)",
     default=False,
 )
+bpy.types.Object.swiftBlock_BlockDetection = bpy.props.EnumProperty(
+    name="Block Detection",
+    items = (("faceLoops","Face Loops","Find Blocks from Loops of Connected Faces",1),
+             ("hexes","Hexahedra","Find Blocks Directly as Hexahedra from Quad Faces",2),
+             ("check","Check","Find Blocks from Face Loops and Check Result Against Hexahedra",3),),
+    description="Block Detection Algorithm",
+    default="faceLoops",
+)
+bpy.types.Object.swiftBlock_incrementalBuild = bpy.props.BoolProperty(
+    name="Incremental",
+    description="Option to Search Blocks Only Around Edges Changed Since Previous Build",
+    default=False,
+)
+# Faces and blocks found by previous build, as JSON
+bpy.types.Object.swiftBlock_blockTopology = bpy.props.StringProperty(default="")
+# Solved edge gradings of previous previews and exports, as JSON
+bpy.types.Object.swiftBlock_gradingCache = bpy.props.StringProperty(default="")
+bpy.types.Object.swiftBlock_splitDict = bpy.props.BoolProperty(
+    name="Split",
+    description="Option to Export Vertices, Blocks and Patches to Files Included by blockMeshDict and Rewrite Only Changed Files",
+    default=False,
+)
+bpy.types.Object.swiftBlock_compressDict = bpy.props.BoolProperty(
+    name="Compress",
+    description="Option to Export blockMeshDict gzip Compressed",
+    default=False,
+)
 
 # Projection/snapping properties
 bpy.types.Object.swiftBlock_projections = \
@@ -88,6 +116,11 @@ bpy.types.Object.swiftBlock_Autosnap = bpy.props.BoolProperty(
     name="Automatic Edge Projection",
     description = "Option to Snap Lines Automatically from Geometry"
 )
+bpy.types.Object.swiftBlock_SnapProcesses = bpy.props.IntProperty(
+    name="Processes",
+    description="Number of Processes Searching Snapped Edges on Large Geometries. More than One Forks Blender, Which Copies Its Memory",
+    default=1, min=1,
+)
 bpy.types.Object.swiftBlock_ShowInternalFaces = bpy.props.BoolProperty(
     name="Show Internal Faces",
     description = "Show Internal Faces",
@@ -196,11 +229,18 @@ class VIEW3D_PT_SwiftBlockPanel(bpy.types.Panel):
             split = box.split(factor=0.5)
             split.operator("swift_block.build_blocking")
             split.prop(ob, "swiftBlock_useNumba")
+            split = box.split(factor=0.5)
+            split.prop(ob, "swiftBlock_BlockDetection", text="")
+            split.prop(ob, "swiftBlock_incrementalBuild")
 
             split = box.split()
             split.operator("swift_block.preview_mesh")
             split = split.split()
             split.operator("swift_block.write_mesh")
+            if ob.swiftBlock_Mesher == "blockMeshMG":
+                split = box.split(factor=0.5)
+                split.prop(ob, "swiftBlock_splitDict")
+                split.prop(ob, "swiftBlock_compressDict")
             box.template_list("SWIFTBLOCK_UL_block_items", "", ob, "swiftBlock_blocks", ob, "swiftBlock_block_index", rows=2)
             box.operator("swift_block.get_block")
 
@@ -264,6 +304,7 @@ class VIEW3D_PT_SwiftBlockPanel(bpy.types.Panel):
                 if ob.swiftBlock_EdgeSnapObject != "":
                     o = split.operator("swift_block.activate_snap",text="",emboss=False,icon="OBJECT_DATA")
                     o.ob = ob.swiftBlock_EdgeSnapObject
+                box.prop(ob, "swiftBlock_SnapProcesses")
             else:
                 box.prop(ob, "swiftBlock_Autosnap")
             box.prop(ob,"swiftBlock_ShowInternalFaces")
@@ -465,6 +506,7 @@ class SWIFTBLOCK_OT_InitBlocking(bpy.types.Operator):
         bm.faces.layers.int.new('enabled') # 0 = disabled, 1 = boundary face, 2 = internal face
 
         ob.swiftBlock_blocks.clear()
+        ob.swiftBlock_blockTopology = ""
         ob.swiftBlock_projections.clear()
         # ob.swiftBlock_edge_groups.clear()
         bpy.ops.swift_block.boundaries_action("INVOKE_DEFAULT",action='ADD')
@@ -487,20 +529,28 @@ class SWIFTBLOCK_OT_BuildBlocking(bpy.types.Operator):
         ob = context.active_object
         bm = bmesh.from_edit_mesh(ob.data)
 
-        verts = []
-        edges = []
-
-        for v in bm.verts:
-            verts.append(v.co)
-        for e in bm.edges:
-            edges.append([e.verts[0].index,e.verts[1].index])
+        verts, edges = blockingFromBMesh(bm)
 
         disabled = [] #not needed anymore
 
+        cache = None
+        previous_blocks = dict()
+        if ob.swiftBlock_incrementalBuild:
+            cache = dict()
+            if ob.swiftBlock_blockTopology:
+                cache = json.loads(ob.swiftBlock_blockTopology)
+            # Keep the settings of blocks which are found again
+            for b in ob.swiftBlock_blocks:
+                previous_blocks[tuple(sorted(b.verts))] = (b.name, b.enabled, b.namedRegion)
+
         print('Beginning automatic block detection')
         stime = time.time()
-        log, block_verts, block_edges, face_info, all_edges, faces_as_list_of_nodes = blockBuilder.blockFinder(edges, verts, disabled = disabled, numba = ob.swiftBlock_useNumba)
+        log, block_verts, block_edges, face_info, all_edges, faces_as_list_of_nodes, edge_group = blockBuilder.blockFinder(edges, verts, disabled = disabled, numba = ob.swiftBlock_useNumba, detection = ob.swiftBlock_BlockDetection, cache = cache)
         print('Found {} blocks in {:.1f} seconds, used Numba={}'.format(len(block_verts), time.time()-stime,ob.swiftBlock_useNumba))
+        if cache is not None:
+            ob.swiftBlock_blockTopology = json.dumps(cache)
+        else:
+            ob.swiftBlock_blockTopology = ""
 
 
         ob.swiftBlock_blocks.clear()
@@ -509,6 +559,8 @@ class SWIFTBLOCK_OT_BuildBlocking(bpy.types.Operator):
             b.id = i
             b.name = 'block'#_{}'.format(i)
             b.verts = bv
+            if tuple(sorted(bv)) in previous_blocks:
+                b.name, b.enabled, b.namedRegion = previous_blocks[tuple(sorted(bv))]
 
         groupl = bm.edges.layers.int.get('groupid')
         bm.verts.ensure_lookup_table()
@@ -569,7 +621,7 @@ class SWIFTBLOCK_OT_BuildBlocking(bpy.types.Operator):
 
         bpy.ops.object.mode_set(mode='OBJECT')
 
-        edgeDirections = utils.getEdgeDirections(block_verts, block_edges)
+        edgeDirections, inconsistent = utils.getEdgeDirections(block_verts, block_edges)
 
         ob = bpy.context.active_object
         edgelist = dict()
@@ -586,7 +638,12 @@ class SWIFTBLOCK_OT_BuildBlocking(bpy.types.Operator):
         updateProjections(ob)
         hideFacesEdges(ob, ob.swiftBlock_ShowInternalFaces)
         bpy.ops.swift_block.draw_edge_directions('INVOKE_DEFAULT',show=False)
-        self.report({'INFO'}, "Number of blocks: {}".format(len(block_verts)))
+        if inconsistent:
+            print('Inconsistent edge directions in edge groups {}'.format(inconsistent))
+            self.report({'WARNING'}, "Number of blocks: {}. Edge directions are inconsistent in {} edge groups, "\
+                "see terminal for the group ids".format(len(block_verts), len(inconsistent)))
+        else:
+            self.report({'INFO'}, "Number of blocks: {}".format(len(block_verts)))
         return {"FINISHED"}
 
 
@@ -598,17 +655,52 @@ class SWIFTBLOCK_OT_PreviewMesh(bpy.types.Operator):
 
     filename: bpy.props.StringProperty(default='')
 
+    # blockMesh runs in the background and the result is loaded when it has
+    # finished. Its output is shown in the status bar, ESC cancels.
     def invoke(self, context, event):
         ob = context.active_object
-        mesh, cells = writeMesh(ob)
-        points, faces = mesh.runMesh()
-        if points == []:
+        self.obName = ob.name
+        self.mesh, cells, gradingCache = writeMesh(ob)
+        self.info = "Cells in mesh: {}, grading cache hits: {}, misses: {}".format(cells, gradingCache.hits, gradingCache.misses)
+        if not self.mesh.startBlockMesh():
             self.report({'ERROR'}, "blockMesh command not found! Preview is unavailable. Source OpenFOAM in terminal and start Blender from that terminal to enable previewing.")
-        else:
-            self.report({'INFO'}, "Cells in mesh: " + str(cells))
-        blender_utils.previewMesh(ob, points, faces)
+            blender_utils.previewMesh(ob, [], [])
+            return {"FINISHED"}
+        self.timer = context.window_manager.event_timer_add(0.1, window=context.window)
+        context.window_manager.modal_handler_add(self)
+        context.workspace.status_text_set("Running blockMesh, press ESC to cancel")
+        return {"RUNNING_MODAL"}
+
+    def modal(self, context, event):
+        process = self.mesh.process
+        if event.type == 'ESC' and event.value == 'PRESS':
+            self.mesh.cancelMesh()
+            self.stop(context)
+            self.report({'WARNING'}, "Preview cancelled")
+            return {"CANCELLED"}
+        if event.type != 'TIMER':
+            return {"PASS_THROUGH"}
+
+        lines = [l.strip() for l in process.output() if l.strip()]
+        if lines:
+            context.workspace.status_text_set("blockMesh: {} (press ESC to cancel)".format(lines[-1]))
+        if not process.finished():
+            return {"PASS_THROUGH"}
+        self.stop(context)
+        if process.failed():
+            self.mesh.cancelMesh()
+            log = [l.strip() for l in process.log if l.strip()]
+            self.report({'ERROR'}, "blockMesh failed: {}".format(" ".join(log[-3:])))
+            return {"CANCELLED"}
+        points, faces = self.mesh.readMesh()
+        self.report({'INFO'}, self.info)
+        blender_utils.previewMesh(bpy.data.objects[self.obName], points, faces)
         return {"FINISHED"}
 
+    def stop(self, context):
+        context.window_manager.event_timer_remove(self.timer)
+        context.workspace.status_text_set(None)
+
 class SWIFTBLOCK_OT_WriteMesh(bpy.types.Operator):
     bl_idname = "swift_block.write_mesh"
     bl_label = "Export"
@@ -637,9 +729,9 @@ class SWIFTBLOCK_OT_WriteMesh(bpy.types.Operator):
 
     def execute(self, context):
         ob = context.active_object
-        mesh, cells = writeMesh(ob, self.filepath)
+        mesh, cells, gradingCache = writeMesh(ob, self.filepath)
         bpy.ops.object.mode_set(mode='EDIT')
-        self.report({'INFO'}, "Cells in mesh: " + str(cells))
+        self.report({'INFO'}, "Cells in mesh: {}, grading cache hits: {}, misses: {}".format(cells, gradingCache.hits, gradingCache.misses))
         return {"FINISHED"}
 
 class SWIFTBLOCK_OT_ActivateBlocking(bpy.types.Operator):
@@ -851,10 +943,8 @@ class SWIFTBLOCK_OT_SetCellSize(bpy.types.Operator):
         r1l = bm.edges.layers.float.get('r1')
         r2l = bm.edges.layers.float.get('r2')
         cellsl = bm.edges.layers.int.get('cells')
-        verts = [v.co for v in bm.verts]
-        edges = [(e.verts[0].index, e.verts[1].index) for e in bm.edges]
-
         if ob.swiftBlock_Autosnap and ob.swiftBlock_EdgeSnapObject:
+            verts, edges = snapEdges(ob, bm)
             polyLines, polyLinesPoints, lengths = getPolyLines(verts, edges, ob)
         else:
             polyLines = []
@@ -0,0 +1,36 @@
+# Shared code for the benchmarks. The add-on modules are loaded as package
+# swiftBlock without executing __init__.py, which requires Blender.
+#
+# python benchmarks/findFace.py
+
+import os
+import sys
+import time
+import types
+
+import numpy as np
+
+if 'swiftBlock' not in sys.modules:
+    package = types.ModuleType('swiftBlock')
+    package.__path__ = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+    sys.modules['swiftBlock'] = package
+
+
+def lattice(n):
+    # Blocking of n x n x n unit blocks: vertex coordinates (N,3) and edges (E,2)
+    ids = np.arange((n+1)**3).reshape(n+1, n+1, n+1)
+    verts = np.indices((n+1, n+1, n+1)).reshape(3,-1).T[:,::-1].astype(float)
+    edges = np.vstack((
+        np.column_stack((ids[:,:,:-1].ravel(), ids[:,:,1:].ravel())),
+        np.column_stack((ids[:,:-1,:].ravel(), ids[:,1:,:].ravel())),
+        np.column_stack((ids[:-1,:,:].ravel(), ids[1:,:,:].ravel()))))
+    return verts, edges
+
+def timeit(function, *args, repeat=3):
+    # Best wall time of repeat calls, and the result of the last call
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
@@ -0,0 +1,39 @@
+# Face lookups of blockFinder on lattice blockings: scanning all faces
+# against the face index.
+#
+# python benchmarks/findFace.py [n ...]
+
+import sys
+
+import common
+from swiftBlock import blockBuilder
+
+
+def blockFaces(blocks):
+    faces = []
+    for vl in blocks:
+        faces.append(vl[0:4])
+        faces.append(vl[4:8])
+        faces.append([vl[0], vl[1], vl[5], vl[4]])
+        faces.append([vl[1], vl[2], vl[6], vl[5]])
+        faces.append([vl[2], vl[3], vl[7], vl[6]])
+        faces.append([vl[3], vl[0], vl[4], vl[7]])
+    return faces
+
+def scan(faces, lookups):
+    return [blockBuilder.findFace(faces, f)[0] for f in lookups]
+
+def indexed(faces, lookups):
+    face_index = blockBuilder.faceIndex(faces)
+    return [blockBuilder.findFace(faces, f, face_index)[0] for f in lookups]
+
+sizes = [int(n) for n in sys.argv[1:]] or [4, 8, 12]
+print('{:>4} {:>8} {:>8} {:>10} {:>10} {:>8}'.format('n', 'faces', 'lookups', 'scan [s]', 'index [s]', 'speedup'))
+for n in sizes:
+    verts, edges = common.lattice(n)
+    log, blocks, dependent_edges, face_info, all_edges, faces, edge_group = blockBuilder.blockFinder(edges, verts)
+    lookups = blockFaces(blocks)
+    tScan, fidsScan = common.timeit(scan, faces, lookups, repeat=1)
+    tIndex, fidsIndex = common.timeit(indexed, faces, lookups)
+    assert fidsScan == fidsIndex
+    print('{:>4} {:>8} {:>8} {:>10.4f} {:>10.4f} {:>8.0f}'.format(n, len(faces), len(lookups), tScan, tIndex, tScan/tIndex))
@@ -20,6 +20,7 @@ import bpy
 from mathutils import Vector, Matrix, Euler
 import bgl
 import bmesh
+import numpy as np
 
 
 
@@ -87,8 +88,21 @@ def previewMesh(ob, points, faces):
     previewMeshOb.hide_set(False)
     previewMeshOb.select_set(True)
     previewMeshOb.swiftBlock_blocking_object = blocking.name
-    mesh_data.from_pydata(points, [], faces)
-    mesh_data.update()
+    if isinstance(faces, np.ndarray) and len(faces):
+        # Faces with the same number of points from the polyMesh reader
+        points = np.asarray(points, dtype=np.float32).reshape(-1,3)
+        mesh_data.vertices.add(len(points))
+        mesh_data.vertices.foreach_set('co', points.ravel())
+        mesh_data.loops.add(faces.size)
+        mesh_data.loops.foreach_set('vertex_index', faces.astype(np.int32).ravel())
+        mesh_data.polygons.add(len(faces))
+        mesh_data.polygons.foreach_set('loop_start', np.arange(0, faces.size, faces.shape[1], dtype=np.int32))
+        if bpy.app.version < (4, 0, 0):
+            mesh_data.polygons.foreach_set('loop_total', np.full(len(faces), faces.shape[1], dtype=np.int32))
+        mesh_data.update(calc_edges=True)
+    else:
+        mesh_data.from_pydata([list(p) for p in points], [], [list(f) for f in faces])
+        mesh_data.update()
 
     bpy.context.view_layer.objects.active = previewMeshOb
     # FIXME: show_extra_edge_length is now Overlay property, find out how to do this.
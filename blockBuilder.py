@@ -1,161 +1,177 @@
-import mathutils
 import time
 import importlib
 import numpy as np
 # from . import cycleFinderNumba
 # importlib.reload(cycleFinderNumba)
 
-def removedup(seq):
-    checked = []
-    for e in seq:
-        if e not in checked:
-            checked.append(e)
-    return checked
-
 def edge(e0, e1):
     return [min(e0,e1), max(e0,e1)]
 
-def couple_edges(dependent_edges):
-    for es0, edgeSet0 in enumerate(dependent_edges):
-        for edge in edgeSet0:
-            for es1, edgeSet1 in enumerate(dependent_edges):
-                if edge in edgeSet1 and es0 != es1:
-                    for e in edgeSet0:
-                        edgeSet1.append(e)
-                    dependent_edges.pop(es0)
-                    return True
-    return False
-
-
-
-def findFace(faces, vl):
+def edgeGroups(dependent_edges):
+    # Couple sets of dependent edges which share edges using a disjoint-set
+    # (union-find) structure keyed on the edge tuples. Returns the coupled
+    # groups and the group id of each edge. Groups are ordered by the last
+    # edge set they contain and edges by their first occurrence.
+    parent = dict()
+
+    def find(e):
+        root = e
+        while parent[root] != root:
+            root = parent[root]
+        while parent[e] != root: # path compression
+            parent[e], e = root, parent[e]
+        return root
+
+    for edgeSet in dependent_edges:
+        keys = [tuple(e) for e in edgeSet]
+        for key in keys:
+            parent.setdefault(key, key)
+        for key in keys[1:]:
+            r0, r1 = find(keys[0]), find(key)
+            if r0 != r1:
+                parent[r1] = r0
+
+    last_set = dict()
+    for es, edgeSet in enumerate(dependent_edges):
+        if edgeSet:
+            last_set[find(tuple(edgeSet[0]))] = es
+    group_ids = {root: gid for gid, root in enumerate(sorted(last_set, key=last_set.get))}
+
+    groups = [[] for i in group_ids]
+    edge_group = dict()
+    for edgeSet in dependent_edges:
+        for e in edgeSet:
+            key = tuple(e)
+            if key not in edge_group:
+                edge_group[key] = group_ids[find(key)]
+                groups[edge_group[key]].append(list(e))
+    return groups, edge_group
+
+def quadNormals(q):
+    # Unit normals of quads given as an (...,4,3) array of vertex coordinates,
+    # same as mathutils.geometry.normal(*q) for each quad
+    normals = np.cross(q[...,0,:]-q[...,2,:], q[...,1,:]-q[...,3,:])
+    length = np.linalg.norm(normals, axis=-1, keepdims=True)
+    np.divide(normals, length, out=normals, where=length > 0)
+    return normals
+
+def faceIndex(faces):
+    # Face ids keyed on the sorted vertices of the faces
+    face_index = {}
+    for fid, f in enumerate(faces):
+        face_index.setdefault(tuple(sorted(f)), fid)
+    return face_index
+
+def findFace(faces, vl, face_index=None):
+    # Without face_index from faceIndex(faces) all faces are scanned
+    if face_index is not None:
+        fid = face_index.get(tuple(sorted(vl)), -1)
+        if fid == -1:
+            return -1, []
+        return fid, faces[fid]
     for fid, f in enumerate(faces):
         if vl[0] in f and vl[1] in f and vl[2] in f and vl[3] in f:
             return fid, f
     return -1, []
 
 
+def csrAdjacency(edges, nverts):
+    # Compressed sparse row adjacency of the edge graph, built in one pass.
+    # The neighbours of vertex v are neighbours[offsets[v]:offsets[v+1]] and
+    # edgeIds holds the index of the connecting edge. Neighbours of each vertex
+    # are ordered by edge index.
+    edges = np.asarray(edges, dtype=int).reshape(-1,2)
+    eids = np.arange(len(edges))
+    source = np.concatenate((edges[:,0], edges[:,1]))
+    target = np.concatenate((edges[:,1], edges[:,0]))
+    eids = np.concatenate((eids, eids))
+    order = np.lexsort((eids, source))
+    offsets = np.zeros(nverts + 1, dtype=int)
+    np.cumsum(np.bincount(source, minlength=nverts), out=offsets[1:])
+    return offsets, target[order], eids[order]
+
+def edgeFaceIndex(faces_as_list_of_edges, nedges):
+    # List of faces sharing each edge, in face order
+    faces_of_edge = [[] for i in range(nedges)]
+    for fid, f in enumerate(faces_as_list_of_edges):
+        for e in f:
+            faces_of_edge[e].append(fid)
+    return faces_of_edge
+
 def cycleFinder(edges,verts):
 # Credit: Adam Gaither, An Efficient Block Detection Algorithm For
 # Structured Grid Generation. Proc. 5th Int. Conf. Num. Grid
 # Generation in Comp. Field Simulations, pp. 443-451 (1996).
-
-    verticesId = verts
-    edgeVisited = np.zeros(len(edges), dtype=bool)
-    faces = []
-    facesEdges = []
-    no_edges = 0
-
-    v_in_edge = [[] for i in range(len(verts))]
-    for v in verts:
-        for eid, e in enumerate(edges):
-            if v in e:
-                v_in_edge[v].append(eid)
-    v_in_edges = np.array(v_in_edge)
-
-    for v in verticesId:
-        currentCycle = [v]
-        currentCycleEdges = []
-        buildFourEdgeFaces(v, v_in_edge, edgeVisited, edges, no_edges, currentCycle, currentCycleEdges, faces, facesEdges)
-
-    faces = np.reshape(faces,(-1,4))
-    temp, u = np.unique(np.sort(faces), axis=0, return_index=True)
-    faces = faces[u]
-    facesP = [list(map(np.asscalar,f)) for f in faces]
-
-    facesEdges = np.reshape(facesEdges,(-1,4))
-    facesEdges = facesEdges[u]
-    facesEdgesP = [list(map(np.asscalar,f)) for f in facesEdges]
-
+#
+# Finds all cycles of four edges. Each quad is enumerated only from its
+# smallest vertex m, as m-a-b-c-m with edge(m,a) < edge(m,c), so no
+# duplicates need to be removed afterwards. Faces are
+# returned in the same order and with the same vertex order as a depth
+# first search started from every vertex would give after removing
+# duplicates: sorted by their vertices, starting from the smallest
+# vertex and walking along its edge with the smaller index.
+
+    offsets, neighbours, edgeIds = csrAdjacency(edges, len(verts))
+    offsets = offsets.tolist()
+    neighbours = neighbours.tolist()
+    edgeIds = edgeIds.tolist()
+    adjacency = [dict(zip(neighbours[offsets[v]:offsets[v+1]], edgeIds[offsets[v]:offsets[v+1]])) \
+                 for v in range(len(verts))]
+
+    quads = dict()
+    for m in range(len(verts)):
+        higher = [(a, ea) for a, ea in zip(neighbours[offsets[m]:offsets[m+1]], edgeIds[offsets[m]:offsets[m+1]]) if a > m]
+        for i, (a, ea) in enumerate(higher):
+            adjacent_a = adjacency[a]
+            for c, ec in higher[i+1:]:
+                adjacent_c = adjacency[c]
+                for b, eab in adjacent_a.items():
+                    if b > m and b in adjacent_c:
+                        key = tuple(sorted((m, a, b, c)))
+                        cycleEdges = (ea, eab, adjacent_c[b], ec)
+                        # Four vertices connected to each other form three
+                        # different quads, keep the one found first
+                        if key not in quads or cycleEdges < quads[key][1]:
+                            quads[key] = ([m, a, b, c], cycleEdges)
+
+    facesP = []
+    facesEdgesP = []
+    for key in sorted(quads):
+        face, faceEdges = quads[key]
+        facesP.append(face)
+        facesEdgesP.append(list(faceEdges))
     return facesP, facesEdgesP
 
-def buildFourEdgeFaces(v, v_in_edge, edgeVisited, edges, no_edges, currentCycle, currentCycleEdges, faces, facesEdges):
-    for eid in v_in_edge[v]:
-        if not edgeVisited[eid]:
-            e = edges[eid]
-            no_edges += 1
-            edgeVisited[eid] = True
-            opposite_v = e[0]
-            if opposite_v == v: # seems the other vertex is in e[1]!
-                opposite_v = e[1]
-            currentCycle.append(opposite_v)
-            currentCycleEdges.append(eid)
-            if currentCycle[0] == currentCycle[-1]: # First equals last -> we have a face
-                if len(currentCycle) == 5:
-                    faces.extend(currentCycle[0:4])
-                if len(currentCycleEdges) == 4:
-                    facesEdges.extend(currentCycleEdges[0:4])
-            else:
-                if no_edges < 4:
-                    buildFourEdgeFaces(opposite_v, v_in_edge, edgeVisited, edges, no_edges, currentCycle, currentCycleEdges, faces, facesEdges)
-            no_edges -= 1
-            currentCycle.pop()
-            currentCycleEdges.pop()
-            edgeVisited[eid] = False
-
-
-def blockFinder(edges, vertices_coord, logFileName='', debugFileName='', disabled = [], numba=False):
-    if len(logFileName) > 0:
-        logFile = open(logFileName,'w')
-    else:
-        logFile = ''
-
-    # Use the cycle finder class to find all edges forming quad faces
-    if numba:
-        from . import cycleFinderNumba
-        tmp_v,tmp_e = cycleFinderNumba.cycleFinder(edges,range(len(vertices_coord)))
-    else:
-        tmp_v,tmp_e = cycleFinder(edges,range(len(vertices_coord)))
-
-    faces_as_list_of_vertices = []
-    faces_as_list_of_nodes = []
-    faces_as_list_of_edges = []
-    for ii, i in enumerate(tmp_v): # get rid of possible triangles
-        if len(i) == 4:
-            faces_as_list_of_vertices.append([vertices_coord[i[0]], vertices_coord[i[1]], vertices_coord[i[2]], vertices_coord[i[3]]])
-            faces_as_list_of_nodes.append(i)
-            faces_as_list_of_edges.append(tmp_e[ii])
-    # Create a wavefront obj file showing all the faces just found
-    if len(debugFileName) > 0:
-        debugFile = open(debugFileName,'w')
-        for v in vertices_coord:
-            debugFile.write('v {} {} {}\n'.format(*v))
-        for f in faces_as_list_of_nodes:
-            debugFile.write('f ')
-            for n in f:
-                debugFile.write('{} '.format(n+1))
-            debugFile.write('\n')
-        debugFile.close()
-
-    # Store some info for the faces in a dict
-    face_info = {}
-    for fid, f in enumerate(faces_as_list_of_vertices):
-        normal = mathutils.geometry.normal(f[0],f[1],f[2],f[3])
-        facecentre = mathutils.Vector((0,0,0))
-        for v in f:
-            facecentre += 0.25*v
-        face_info[fid] = {}
-        face_info[fid]['normal'] = normal
-        face_info[fid]['pos'] = []
-        face_info[fid]['neg'] = []
-        face_info[fid]['centre'] = facecentre
 
+def faceLoopFinder(faces_as_list_of_nodes, faces_as_list_of_edges, faces_of_edge, numba=False, logFile=''):
+    # Find blocks as loops of four connected faces where the first and the
+    # third face do not share any vertices.
+    # Find connections between faces, i.e. they share one edge. Pairs are
+    # generated per shared edge from an edge->faces index and kept in the
+    # order the faces and their edges are listed.
+    stime = time.time()
     connections_between_faces = []
-    # Find connections between faces, i.e. they share one edge
+    connected = set()
     for fid1, f1 in enumerate(faces_as_list_of_edges):
         for e in f1:
-            for fid2, f2 in enumerate(faces_as_list_of_edges):
-                if e in f2 and not fid1 == fid2:
-                    if not [min(fid1,fid2),max(fid1,fid2)] in connections_between_faces:
-                        connections_between_faces.append([min(fid1,fid2),max(fid1,fid2)])
+            for fid2 in faces_of_edge[e]:
+                if fid1 < fid2 and (fid1,fid2) not in connected:
+                    connected.add((fid1,fid2))
+                    connections_between_faces.append([fid1,fid2])
+    connections_info = 'Found {} connections between {} faces in {:.2f} seconds'.format(
+        len(connections_between_faces), len(faces_as_list_of_edges), time.time()-stime)
+    print(connections_info)
+    if logFile:
+        logFile.write(connections_info + '\n')
 
     #this is the most time consuming step
     # Use these connections to find cycles of connected faces; called faceLoops
     if numba:
-        faceLoops_as_list_of_faces, faceLoops_as_list_of_connections = cycleFinderNumba.cycleFinder(connections_between_faces,range(len(faces_as_list_of_vertices)))
+        from . import cycleFinderNumba
+        faceLoops_as_list_of_faces, faceLoops_as_list_of_connections = cycleFinderNumba.cycleFinder(connections_between_faces,range(len(faces_as_list_of_nodes)))
     else:
-        faceLoops_as_list_of_faces, faceLoops_as_list_of_connections = cycleFinder(connections_between_faces,range(len(faces_as_list_of_vertices)))
-    # faceLoops_as_list_of_faces, faceLoops_as_list_of_connections = blockBuilder2.cycleFinder(connections_between_faces,range(len(faces_as_list_of_vertices)))
+        faceLoops_as_list_of_faces, faceLoops_as_list_of_connections = cycleFinder(connections_between_faces,range(len(faces_as_list_of_nodes)))
+    # faceLoops_as_list_of_faces, faceLoops_as_list_of_connections = blockBuilder2.cycleFinder(connections_between_faces,range(len(faces_as_list_of_nodes)))
 
 
     # Dig out block structures from these face loops
@@ -176,103 +192,341 @@ def blockFinder(edges, vertices_coord, logFileName='', debugFileName='', disable
                     faceLoops_nodes[qfid].append(n)
     for qf in faceLoops_nodes:
         qf.sort()
-    tmp = []
+    tmp = set()
     potentialBlocks = [] # Each block is identified several times. Condense and put in potentialBlocks (list of vertices index)
     for qfid, qf in enumerate(faceLoops_nodes):
-        if not qf in tmp:
-            tmp.append(qf)
+        if not tuple(qf) in tmp:
+            tmp.add(tuple(qf))
             if len(qf) == 8:
                 potentialBlocks.append(block_as_faceLoop[qfid])
-    offences = []
+    return potentialBlocks
+
+def hexFinder(faces_as_list_of_nodes, faces_as_list_of_edges, faces_of_edge, face_index, start=None):
+    # Find blocks directly as hexahedra: for each quad face, walk over a side
+    # face to the opposite quad and check that the other three side faces
+    # exist. Hexahedra are identified by their sorted vertices. The result is
+    # in the same format and order as from faceLoopFinder: one loop of faces
+    # [f0, f1, f2, f3] per block where f0 and f2 are opposite faces, f0 being
+    # the face with the smallest index. With start, only the blocks having
+    # one of these faces are found.
+    def across(face, a, b):
+        # vertices of face connected to a and b, in this order, when a-b is an edge of face
+        ia, ib = face.index(a), face.index(b)
+        if (ia + 1) % 4 == ib:
+            return face[(ia+3)%4], face[(ia+2)%4]
+        return face[(ib+2)%4], face[(ib+3)%4]
+
+    if start is None:
+        start = range(len(faces_as_list_of_nodes))
+    hexes = dict()
+    for f0 in start:
+        q1 = faces_as_list_of_nodes[f0]
+        for s0 in faces_of_edge[faces_as_list_of_edges[f0][0]]:
+            if s0 == f0:
+                continue
+            side = faces_as_list_of_nodes[s0]
+            w0, w1 = across(side, q1[0], q1[1])
+            if w0 in q1 or w1 in q1:
+                continue
+            top_edge = [faces_as_list_of_edges[s0][i] for i in range(4) if not side[i] in q1 and not side[(i+1)%4] in q1][0]
+            for f1 in faces_of_edge[top_edge]:
+                if f1 == s0:
+                    continue
+                q2 = faces_as_list_of_nodes[f1]
+                w3, w2 = across(q2, w0, w1)
+                if w2 in q1 or w3 in q1:
+                    continue
+                q2 = [w0, w1, w2, w3]
+                sides = [face_index.get(tuple(sorted((q1[i], q1[(i+1)%4], q2[(i+1)%4], q2[i])))) for i in range(4)]
+                if None in sides:
+                    continue
+                key = tuple(sorted(q1 + q2))
+                if key in hexes:
+                    continue
+                # opposite faces are next to each other
+                faces = [f0, f1, sides[0], sides[2], sides[1], sides[3]]
+                first = faces.index(min(faces))
+                opposite = faces[first ^ 1]
+                others = sorted(faces[:first & 6] + faces[(first & 6) + 2:])
+                hexes[key] = [faces[first], others[0], opposite, others[1]]
+
+    # Order as the first face loop of each block would be found
+    return sorted(hexes.values(), key=lambda b: sorted(b))
+
+def sortedFaceLoop(b, faces_as_list_of_nodes, faces_as_list_of_edges, faces_of_edge):
+    # Face loop of a block as hexFinder gives it: the first face, the
+    # smallest side face, the opposite face and the second smallest side
+    # face. Loops of blocks with missing side faces are returned as they are.
+    q2 = set(faces_as_list_of_nodes[b[2]])
+    sides = set()
+    for e in faces_as_list_of_edges[b[0]]:
+        for f in faces_of_edge[e]:
+            if f != b[0] and len(q2.intersection(faces_as_list_of_nodes[f])) == 2:
+                sides.add(f)
+    if len(sides) != 4:
+        return b
+    sides = sorted(sides)
+    return [b[0], sides[0], b[2], sides[1]]
+
+def cachedFaces(edges, nverts, cache, numba=False):
+    # Quad faces from the faces of a previous blockFinder call in cache.
+    # Faces of which all edges still exist are kept, new faces are searched
+    # only from the edges around the added edges. Returns the faces as lists
+    # of vertices and edges in the same order as cycleFinder, the previous
+    # id of each face (-1 for new faces) and the numbers of added and removed
+    # edges.
+    edge_id = dict()
+    for eid, e in enumerate(edges):
+        edge_id.setdefault((min(e), max(e)), eid)
+    old_edges = set((min(e), max(e)) for e in cache['edges'])
+    added = set(eid for key, eid in edge_id.items() if key not in old_edges)
+    removed = len(old_edges - set(edge_id))
+
+    faces = dict()
+    for oldid, f in enumerate(cache['faces']):
+        faceEdges = [edge_id.get((min(f[i], f[(i+1)%4]), max(f[i], f[(i+1)%4]))) for i in range(4)]
+        if not None in faceEdges:
+            faces[tuple(sorted(f))] = (f, faceEdges, oldid)
+
+    if added:
+        # A new face has an added edge, all its vertices are at most one
+        # edge away from the added edges
+        near = set()
+        for eid in added:
+            near.update(edges[eid])
+        around = set(near)
+        for e in edges:
+            if e[0] in near or e[1] in near:
+                around.update(e)
+        sub_edges = [eid for eid, e in enumerate(edges) if e[0] in around and e[1] in around]
+        if numba:
+            from . import cycleFinderNumba
+            tmp_v,tmp_e = cycleFinderNumba.cycleFinder([edges[eid] for eid in sub_edges], range(nverts))
+        else:
+            tmp_v,tmp_e = cycleFinder([edges[eid] for eid in sub_edges], range(nverts))
+        for f, fe in zip(tmp_v, tmp_e):
+            faceEdges = [sub_edges[eid] for eid in fe]
+            key = tuple(sorted(f))
+            if key not in faces and any(eid in added for eid in faceEdges):
+                faces[key] = (f, faceEdges, -1)
+
+    faces_as_list_of_nodes = []
+    faces_as_list_of_edges = []
+    previous = []
+    for key in sorted(faces):
+        f, faceEdges, oldid = faces[key]
+        faces_as_list_of_nodes.append(f)
+        faces_as_list_of_edges.append(faceEdges)
+        previous.append(oldid)
+    return faces_as_list_of_nodes, faces_as_list_of_edges, previous, len(added), removed
+
+def formalBlockFilter(potentialBlocks, faces_as_list_of_nodes, face_centres, vertices_coord, edges, logFile=''):
+    # Blocks of the potential blocks (face loops) which have all edges and
+    # are not flat. Returns the vertices of each block, ordered to form a
+    # right-handed hexahedron, and the block centres.
     block_centres = []
     formalBlocks = []
-    dependent_edges = []
-    all_edges = []
-    if len(logFileName) > 0:
-        logFile.write('number of potential blocks identified = ' + str(len(potentialBlocks)) + '\n')
-
+    # Neighbours of each vertex in edge order and the edges as sorted vertex
+    # pairs, for finding connected vertices of the two quads of a block
+    offsets, neighbours = csrAdjacency(edges, len(vertices_coord))[:2]
+    vertex_neighbours = [n.tolist() for n in np.split(neighbours, offsets[1:-1])]
+    edge_set = set((min(e), max(e)) for e in edges)
+
+    # Order the vertices of the second quad of each potential block so that
+    # its first vertex is connected to the first vertex of the first quad
+    blocks = []
+    quads2 = []
+    complete = []
     for b in potentialBlocks:
-        is_a_real_block = True  # more sanity checks soon...
         block = []
         for n in faces_as_list_of_nodes[b[0]]:
             block.append(n)
         for n in faces_as_list_of_nodes[b[2]]:
             block.append(n)
         q2start = None
-        for e in edges: # Locate the vertex just above block[0]. Store as q2start
-            if block[0] == e[0]:
-                if e[1] in block[4:8]:
-                    q2start = block.index(e[1])
-            if block[0] == e[1]:
-                if e[0] in block[4:8]:
-                    q2start = block.index(e[0])
+        for n in vertex_neighbours[block[0]]: # Locate the vertex just above block[0]. Store as q2start
+            if n in block[4:8]:
+                q2start = block.index(n)
+        complete.append(q2start != None)
         if q2start == None: # if not found above - this is not a complete block.
-            q1nodes = block[0:4]
-            q2nodes = block[4:-1]
-            if len(logFileName) > 0:
-                logFile.write('one block found was incomplete! ' + str(q1nodes) + str(q2nodes) + '\n')
-            continue
             q2start = 0 #just set it to something. block wont be printed anyway
-        quad1 = block[0:4]
-        quad2 = []
-        for i in range(4):
-            quad2.append(block[(i + q2start) % 4 + 4])
-        q1verts = [vertices_coord[quad1[0]],vertices_coord[quad1[1]],vertices_coord[quad1[2]],vertices_coord[quad1[3]]]
-        q2verts = [vertices_coord[quad2[0]],vertices_coord[quad2[1]],vertices_coord[quad2[2]],vertices_coord[quad2[3]]]
-
-        blockcentre = mathutils.Vector((0,0,0))
-        for n in block:
-            blockcentre += 0.125*vertices_coord[n]
-        q1fid, tmp = findFace(faces_as_list_of_nodes, quad1)
-        q2fid, tmp = findFace(faces_as_list_of_nodes, quad2)
-
-        normal1 = mathutils.geometry.normal(*q1verts)
-        normal2 = mathutils.geometry.normal(*q2verts)
-
-        facecentre1 = face_info[q1fid]['centre']
-        facecentre2 = face_info[q2fid]['centre']
-        direction1 = blockcentre-facecentre1
-        direction2 = blockcentre-facecentre2
-
-        v04 = q2verts[0] - q1verts[0]
-        scalarProd1 = direction1.dot(normal1)
-        scalarProd2 = direction2.dot(normal2)
-        scalarProd3 = normal1.dot(v04)
-
-        if scalarProd1*scalarProd2 > 0.: # make quad1 and quad2 rotate in the same direction
+        blocks.append(block)
+        quads2.append([block[(i + q2start) % 4 + 4] for i in range(4)])
+
+    # Orientation and flatness of all potential blocks at once
+    blocks = np.array(blocks, dtype=int).reshape(-1,8)
+    quads1 = blocks[:,0:4]
+    quads2 = np.array(quads2, dtype=int).reshape(-1,4)
+    q1verts = vertices_coord[quads1]
+    q2verts = vertices_coord[quads2]
+    face_pairs = np.array([(b[0], b[2]) for b in potentialBlocks], dtype=int).reshape(-1,2)
+    blockcentres = 0.125*vertices_coord[blocks].sum(axis=1)
+    normals1 = quadNormals(q1verts)
+    normals2 = quadNormals(q2verts)
+    direction1 = blockcentres - face_centres[face_pairs[:,0]]
+    direction2 = blockcentres - face_centres[face_pairs[:,1]]
+    v04 = q2verts[:,0] - q1verts[:,0]
+    scalarProd1 = np.einsum('ij,ij->i', direction1, normals1)
+    scalarProd2 = np.einsum('ij,ij->i', direction2, normals2)
+    scalarProd3 = np.einsum('ij,ij->i', normals1, v04)
+    reverse = scalarProd1*scalarProd2 > 0. # make quad1 and quad2 rotate in the same direction
+    swap = scalarProd3 < 0. # Maintain righthanded system in each block
+    scale = np.linalg.norm(v04, axis=1) * np.linalg.norm(normals1, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        flat = np.abs(scalarProd3/scale) < 0.01 # abs(sin(alpha)) < 0.01, where alpha is angle for normal1 and v04
+
+    for bid in range(len(potentialBlocks)):
+        quad1 = quads1[bid].tolist()
+        quad2 = quads2[bid].tolist()
+        if not complete[bid]:
+            if logFile:
+                logFile.write('one block found was incomplete! ' + str(quad1) + str(quad2[:3]) + '\n')
+            continue
+        if reverse[bid]:
             quad2 = [quad2[0], quad2[-1], quad2[-2], quad2[-3]]
-            normal2 *= -1.0
-
-        if scalarProd3 < 0.: # Maintain righthanded system in each block
-            tmp = list(quad2)
-            quad2 = list(quad1)
-            quad1 = tmp
+        if swap[bid]:
+            quad1, quad2 = quad2, quad1
 
+        is_a_real_block = True
         for nid,n in enumerate(quad1): #check that all edges are present
-            if not (([n,quad2[nid]] in edges) or ([quad2[nid],n] in edges)):
-                if len(logFileName) > 0:
+            if not (min(n,quad2[nid]), max(n,quad2[nid])) in edge_set:
+                if logFile:
                     logFile.write('one block did not have all edges! ' + str(quad1) + str(quad2) + '\n')
                 is_a_real_block = False
                 break
         if not is_a_real_block:
             continue
-   # more sanity...
-        scale = v04.magnitude * normal1.magnitude
-        if (abs(scalarProd3/scale) < 0.01): # abs(sin(alpha)) < 0.01, where alpha is angle for normal1 and v04
-            if len(logFileName) > 0:
+        if flat[bid]:
+            if logFile:
                 logFile.write('flat block ruled out!' + str(quad1) + str(quad2) + '\n')
             continue
 
-        if is_a_real_block: # this write-out only works if blenders own vertex numbering starts at zero!! seems to work...
-            offences.append(0)
-            block_centres.append(blockcentre)
+        block_centres.append(blockcentres[bid])
+        vl = quad1 + quad2
+        formalBlocks.append(vl) # list of verts defining the block in correct order
+    return formalBlocks, block_centres
+
+def blockFinder(edges, vertices_coord, logFileName='', debugFileName='', disabled = [], numba=False, detection='faceLoops', cache=None):
+    # edges: pairs of vertex indices, vertices_coord: vertex coordinates.
+    # Both can be lists or NumPy arrays.
+    # cache: dict to store the detected faces and blocks in. If it holds the
+    # result of a previous call, blocks are only searched around the changed
+    # edges and detection is skipped if the edges have not changed.
+    edges = np.asarray(edges, dtype=int).reshape(-1,2).tolist()
+    vertices_coord = np.asarray(vertices_coord, dtype=float).reshape(-1,3)
+    if len(logFileName) > 0:
+        logFile = open(logFileName,'w')
+    else:
+        logFile = ''
+
+    previous = None
+    if cache:
+        faces_as_list_of_nodes, faces_as_list_of_edges, previous, added, removed = \
+            cachedFaces(edges, len(vertices_coord), cache, numba)
+    else:
+        # Use the cycle finder class to find all edges forming quad faces
+        if numba:
+            from . import cycleFinderNumba
+            tmp_v,tmp_e = cycleFinderNumba.cycleFinder(edges,range(len(vertices_coord)))
+        else:
+            tmp_v,tmp_e = cycleFinder(edges,range(len(vertices_coord)))
+
+        faces_as_list_of_nodes = []
+        faces_as_list_of_edges = []
+        for ii, i in enumerate(tmp_v): # get rid of possible triangles
+            if len(i) == 4:
+                faces_as_list_of_nodes.append(i)
+                faces_as_list_of_edges.append(tmp_e[ii])
+    # Coordinates of the face vertices as an (F,4,3) array
+    face_verts = vertices_coord[np.array(faces_as_list_of_nodes, dtype=int).reshape(-1,4)]
+    # Create a wavefront obj file showing all the faces just found
+    if len(debugFileName) > 0:
+        debugFile = open(debugFileName,'w')
+        for v in vertices_coord:
+            debugFile.write('v {} {} {}\n'.format(*v))
+        for f in faces_as_list_of_nodes:
+            debugFile.write('f ')
+            for n in f:
+                debugFile.write('{} '.format(n+1))
+            debugFile.write('\n')
+        debugFile.close()
+
+    # Store some info for the faces in a dict
+    face_normals = quadNormals(face_verts)
+    face_centres = 0.25*(face_verts[:,0]+face_verts[:,1]+face_verts[:,2]+face_verts[:,3])
+    face_info = {}
+    for fid in range(len(faces_as_list_of_nodes)):
+        face_info[fid] = {}
+        face_info[fid]['normal'] = face_normals[fid]
+        face_info[fid]['pos'] = []
+        face_info[fid]['neg'] = []
+        face_info[fid]['centre'] = face_centres[fid]
+
+    face_index = faceIndex(faces_as_list_of_nodes)
+    faces_of_edge = edgeFaceIndex(faces_as_list_of_edges, len(edges))
+    if previous is not None:
+        # Keep the blocks of which all faces were kept and find the blocks
+        # having new faces
+        new_id = dict((oldid, fid) for fid, oldid in enumerate(previous) if oldid != -1)
+        potentialBlocks = [[new_id[f] for f in b] for b in cache['blocks'] if all(f in new_id for f in b)]
+        new_faces = [fid for fid, oldid in enumerate(previous) if oldid == -1]
+        if added or removed:
+            # Blocks which had missing side faces are found again, prefer
+            # the new ones
+            newBlocks = hexFinder(faces_as_list_of_nodes, faces_as_list_of_edges, faces_of_edge, face_index, new_faces)
+            found = set(tuple(sorted(faces_as_list_of_nodes[b[0]] + faces_as_list_of_nodes[b[2]])) for b in newBlocks)
+            for b in potentialBlocks:
+                if not tuple(sorted(faces_as_list_of_nodes[b[0]] + faces_as_list_of_nodes[b[2]])) in found:
+                    newBlocks.append(b)
+            potentialBlocks = sorted(newBlocks, key=lambda b: sorted(b))
+            cache_info = 'Updated blocks around {} added and {} removed edges, {} new faces'.format(added, removed, len(new_faces))
+        else:
+            cache_info = 'Edges have not changed, skipped block detection'
+        print(cache_info)
+        if len(logFileName) > 0:
+            logFile.write(cache_info + '\n')
+    elif detection == 'hexes':
+        potentialBlocks = hexFinder(faces_as_list_of_nodes, faces_as_list_of_edges, faces_of_edge, face_index)
+    else:
+        potentialBlocks = faceLoopFinder(faces_as_list_of_nodes, faces_as_list_of_edges, faces_of_edge, numba, logFile)
+    if cache is not None:
+        cache['edges'] = edges
+        cache['faces'] = faces_as_list_of_nodes
+        cache['blocks'] = [sortedFaceLoop(b, faces_as_list_of_nodes, faces_as_list_of_edges, faces_of_edge) for b in potentialBlocks]
+
+    dependent_edges = []
+    all_edges = []
+    all_edges_set = set()
+    if len(logFileName) > 0:
+        logFile.write('number of potential blocks identified = ' + str(len(potentialBlocks)) + '\n')
 
-            vl = quad1 + quad2
-            formalBlocks.append(vl) # list of verts defining the block in correct order
+    formalBlocks, block_centres = formalBlockFilter(potentialBlocks, faces_as_list_of_nodes, face_centres, vertices_coord, edges, logFile)
+    if detection == 'check' and previous is None:
+        # Compare the blocks which pass the completeness and flatness checks,
+        # face loops may include incomplete blocks which are ruled out here
+        hexBlocks = hexFinder(faces_as_list_of_nodes, faces_as_list_of_edges, faces_of_edge, face_index)
+        hexFormalBlocks = formalBlockFilter(hexBlocks, faces_as_list_of_nodes, face_centres, vertices_coord, edges)[0]
+        if formalBlocks == hexFormalBlocks:
+            print('Block detection check passed, {} blocks'.format(len(formalBlocks)))
+        else:
+            faceLoopKeys = set(tuple(sorted(vl)) for vl in formalBlocks)
+            hexKeys = set(tuple(sorted(vl)) for vl in hexFormalBlocks)
+            missing = [list(k) for k in faceLoopKeys - hexKeys]
+            extra = [list(k) for k in hexKeys - faceLoopKeys]
+            check_info = 'Block detection check failed! Blocks found only by face loops {}, only by hexahedra {}'.format(missing, extra)
+            if not missing and not extra:
+                check_info = 'Block detection check failed! Blocks are in different order'
+            print(check_info)
+            if len(logFileName) > 0:
+                logFile.write(check_info + '\n')
 # formalBlocks are blocks that hava formal block structure and are not flat. Still in an O-mesh there are more formal
 # blocks present than what we want. More filtering...
 
-    for bid, vl in enumerate(formalBlocks):
+    offences = [0]*len(formalBlocks)
+
+    # Which side of its faces each formal block is on
+    block_fids = []
+    for vl in formalBlocks:
         fs = []
         fs.append(vl[0:4])
         fs.append(vl[4:8])
@@ -280,12 +534,12 @@ def blockFinder(edges, vertices_coord, logFileName='', debugFileName='', disable
         fs.append([vl[1], vl[2], vl[6], vl[5]])
         fs.append([vl[2], vl[3], vl[7], vl[6]])
         fs.append([vl[3], vl[0], vl[4], vl[7]])
-        blockcentre = block_centres[bid]
-        for f in fs:
-            fid, tmp = findFace(faces_as_list_of_nodes, f)
-            normal = face_info[fid]['normal']
-            facecentre = face_info[fid]['centre']
-            direction = normal.dot((blockcentre-facecentre))
+        block_fids.append([findFace(faces_as_list_of_nodes, f, face_index)[0] for f in fs])
+    block_fids = np.array(block_fids, dtype=int).reshape(-1,6)
+    block_centres = np.array(block_centres, dtype=float).reshape(-1,3)
+    directions = np.einsum('ijk,ijk->ij', face_normals[block_fids], block_centres[:,None,:] - face_centres[block_fids])
+    for bid, fids in enumerate(block_fids.tolist()):
+        for fid, direction in zip(fids, directions[bid]):
             if direction >= 0.:
                 face_info[fid]['pos'].append(bid)
             else:
@@ -311,12 +565,10 @@ def blockFinder(edges, vertices_coord, logFileName='', debugFileName='', disable
             dependent_edges.append(j_edges) #these 4 edges have the same resolution
             dependent_edges.append(k_edges) #these 4 edges have the same resolution
             for e in range(4):
-                if not i_edges[e] in all_edges:
-                    all_edges.append(i_edges[e])
-                if not j_edges[e] in all_edges:
-                    all_edges.append(j_edges[e])
-                if not k_edges[e] in all_edges:
-                    all_edges.append(k_edges[e])
+                for be in (i_edges[e], j_edges[e], k_edges[e]):
+                    if not tuple(be) in all_edges_set:
+                        all_edges_set.add(tuple(be))
+                        all_edges.append(be)
         else:  # Dont let non-allowed blocks to stop definition of patch names
             for f in face_info:
                 if bid in face_info[f]['pos']:
@@ -325,14 +577,6 @@ def blockFinder(edges, vertices_coord, logFileName='', debugFileName='', disable
                 if bid in face_info[f]['neg']:
                     ind = face_info[f]['neg'].index(bid)
                     face_info[f]['neg'].pop(ind)
-    # stime = time.time()
-    #this is the second most time consuming step
-    still_coupling = True
-    while still_coupling:
-        still_coupling = couple_edges(dependent_edges)
-    # blockBuilder2.couple_edges(dependent_edges)
-    # print('still coupling, t',time.time() - stime)
-
-    for es, edgeSet in enumerate(dependent_edges): # remove duplicates in lists
-        dependent_edges[es] = removedup(edgeSet)
-    return logFile, block_print_out, dependent_edges, face_info, all_edges, faces_as_list_of_nodes
+    # Couple the edges which have the same resolution
+    dependent_edges, edge_group = edgeGroups(dependent_edges)
+    return logFile, block_print_out, dependent_edges, face_info, all_edges, faces_as_list_of_nodes, edge_group
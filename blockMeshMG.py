@@ -5,9 +5,139 @@ import subprocess
 import shutil
 import itertools
 import glob
-from . import utils
+import gzip
+import hashlib
+import queue
+import threading
+from . import grading
+from . import polyMesh
+
+# Write buffer of the dictionaries, and the number of lines formatted at once
+bufferSize = 1 << 20
+chunkSize = 10000
+
+def formatLines(line, rows):
+    # Lines of rows formatted with line, one format call per chunk of rows
+    for i in range(0, len(rows), chunkSize):
+        chunk = rows[i:i+chunkSize]
+        yield (line*len(chunk)).format(*itertools.chain.from_iterable(chunk))
+
+def vertexLines(verts, vert2surf):
+    # Coordinates are written as Python floats, as with '{}'.format(x)
+    verts = np.array(verts, dtype=float).reshape(-1,3).tolist()
+    if not vert2surf:
+        return formatLines('    ({} {} {})\n', verts)
+    lines = []
+    for i,v in enumerate(verts):
+        if i in vert2surf:
+            lines.append('    project ({} {} {}) ({})\n'.format(*v,vert2surf[i]))
+        else:
+            lines.append('    ({} {} {})\n'.format(*v))
+    return lines
+
+def blockEdgeRows(edgeInfo, blocks):
+    # Rows of the 12 edges of blocks (B,8) in the edge grading array
+    blockEdges = blocks[:,[(0,1),(3,2),(7,6),(4,5),(0,3),(1,2),(5,6),(4,7),(0,4),(1,5),(2,6),(3,7)]]
+    return grading.edgeRows(edgeInfo, blockEdges.reshape(-1,2)).reshape(-1,12)
+
+def edgeGradingStrings(rows, values, line):
+    # edgeGrading strings of the blocks from the values (E,k) of the rows
+    # (B,12). Most edges share their grading with others, so only distinct
+    # values are formatted. Values are compared bitwise, -0 is written as -0.
+    if not len(rows):
+        return []
+    used, usedInverse = np.unique(rows, return_inverse=True)
+    values = np.ascontiguousarray(values[used], dtype=float)
+    distinct, index, inverse = np.unique(values.view(np.int64), axis=0, return_index=True, return_inverse=True)
+    strings = [line.format(*v) for v in values[index].tolist()]
+    ids = inverse.reshape(-1)[usedInverse.reshape(-1)].reshape(rows.shape)
+    return [''.join([strings[i] for i in b]) for b in ids.tolist()]
+
+def hexLines(blocks, blockNames, N, gradings, end):
+    # Block lines with the cells N (B,3) and the edgeGrading strings
+    numbers = np.column_stack((np.arange(len(blocks)), blocks, N)).tolist()
+    line = '// block id {0[0]} \nhex ({0[1]} {0[2]} {0[3]} {0[4]} {0[5]} {0[6]} {0[7]} {0[8]}) {1} ' \
+           '({0[9]} {0[10]} {0[11]}) edgeGrading ({2}' + end
+    return map(line.format, numbers, blockNames, gradings)
+
+def writeDictionary(path, chunks, compress=False, checkHash=False):
+    # Write the string chunks of a dictionary to path, or compressed to
+    # path.gz, which OpenFOAM reads as well. The other one of the two is
+    # removed so that OpenFOAM does not read a stale file. With checkHash the
+    # SHA-1 of the content is written on the first line and the file is not
+    # rewritten if it already has the same content. Returns True if the file
+    # was written.
+    chunks = [c.encode() for c in chunks]
+    target, other = (path + '.gz', path) if compress else (path, path + '.gz')
+    if checkHash:
+        sha1 = hashlib.sha1()
+        for c in chunks:
+            sha1.update(c)
+        hashLine = '// sha1 {}\n'.format(sha1.hexdigest()).encode()
+        if os.path.isfile(target):
+            with (gzip.open if compress else open)(target, 'rb') as fin:
+                if fin.readline() == hashLine and not os.path.isfile(other):
+                    return False
+        chunks.insert(0, hashLine)
+    if os.path.isfile(other):
+        os.remove(other)
+    if compress:
+        with gzip.GzipFile(target, 'wb', mtime=0) as fout:
+            fout.writelines(chunks)
+    else:
+        with open(target, 'wb', buffering=bufferSize) as fout:
+            fout.writelines(chunks)
+    return True
+
+class BlockMeshProcess():
+    # blockMesh running in the background. A thread collects its output
+    # lines, so that the caller can poll for progress without blocking.
+    def __init__(self, command):
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, \
+            universal_newlines=True)
+        self.lines = queue.Queue()
+        self.log = []
+        self.thread = threading.Thread(target=self.readOutput, daemon=True)
+        self.thread.start()
+
+    def readOutput(self):
+        for line in self.process.stdout:
+            self.lines.put(line.rstrip())
+        self.process.stdout.close()
+
+    def output(self):
+        # Output lines since the previous call
+        lines = []
+        while True:
+            try:
+                lines.append(self.lines.get_nowait())
+            except queue.Empty:
+                break
+        self.log.extend(lines)
+        return lines
+
+    def finished(self):
+        return self.process.poll() is not None and not self.thread.is_alive()
+
+    def failed(self):
+        return self.process.returncode != 0
+
+    def wait(self):
+        self.process.wait()
+        self.thread.join()
+        self.output()
+
+    def cancel(self):
+        self.process.terminate()
+        self.wait()
+
 class PreviewMesh():
-    def __init__(self, folder=None):
+    # With split, vertices, blocks and patches are written to files included
+    # by blockMeshDict, and only changed files are rewritten. With compress,
+    # the dictionaries are written gzip compressed.
+    def __init__(self, folder=None, split=False, compress=False):
+        self.split = split
+        self.compress = compress
         #if not shutil.which('blockMesh'):
         #    # raise RuntimeError('ERROR: Could not find blockMesh! Please source OpenFOAM in terminal and start Blender from that terminal so that BlockMeshMG finds blockMesh command.')
         #else:
@@ -37,186 +167,89 @@ class PreviewMesh():
             os.mkdir(os.path.join(self.tempdir, 'system'))
             os.mkdir(os.path.join(self.tempdir, '0'))
             cd = open(os.path.join(self.tempdir, 'system', 'controlDict'), 'w')
-            cd.write(self.header())
+            cd.write(self.previewControlDict())
             print('OpenFOAM temp directory: {}'.format(self.tempdir))
 
     def writeBlockMeshDict(self, verts, convertToMeters, boundaries, polyLines, edgeInfo, blockNames, blocks, dependent_edges,\
             projections):
-        bmFile = open(self.blockMeshDictPath,'w')
-        bmFile.write(self.header())
-        bmFile.write('\ngeometry\n{\n')
-        for g in projections['geo']:
-            bmFile.write('   {geo}\n   {{\n      type triSurfaceMesh;\n      file "{geo}.stl";\n   }}\n'.format(geo=g))
+        blocks = np.array(blocks, dtype=int).reshape(-1,8)
+        rows = blockEdgeRows(edgeInfo, blocks)
+        values = np.column_stack([edgeInfo[name] for name in ('l1','n1','ratio1','dL','nL')] + [np.ones(len(edgeInfo))] + \
+            [edgeInfo[name] for name in ('l2','n2')] + [1/edgeInfo['ratio2']])
+        gradings = edgeGradingStrings(rows, values, \
+            '\n(\n ({:.6g} {:.6g} {:.6g}) ({:.6g} {:.6g} {:.6g}) ({:.6g} {:.6g} {:.6g}) \n)')
+        N = edgeInfo['N'][rows[:,[0,4,8]]]
 
-        bmFile.write("}\nvertices\n(\n")
-        for i,v in enumerate(verts):
-            if i in projections['vert2surf']:
-                bmFile.write('    project ({} {} {}) ({})\n'.format(*v,projections['vert2surf'][i]))
-            else:
-                bmFile.write('    ({} {} {})\n'.format(*v))
+        main = [self.header(), '\ngeometry\n{\n']
+        for g in projections['geo']:
+            main.append('   {geo}\n   {{\n      type triSurfaceMesh;\n      file "{geo}.stl";\n   }}\n'.format(geo=g))
+        main.append("}\n")
+        vertices = ["vertices\n(\n", *vertexLines(verts, projections['vert2surf']), ");\n"]
 
-        bmFile.write(");\nedges\n(\n")
+        edges = ["edges\n(\n"]
         for key, value in projections['edge2surf'].items():
-            bmFile.write('    projectCurve {} {} ({})\n'.format(*key, value))
-        for pl in polyLines:
-            bmFile.write(pl)
-
-        bmFile.write(");\nfaces\n(\n")
+            edges.append('    projectCurve {} {} ({})\n'.format(*key, value))
+        edges.extend(polyLines)
+        edges.append(");\nfaces\n(\n")
         for key, value in projections['face2surf'].items():
             # for v in value:
-            bmFile.write('    project ({} {} {} {}) {}\n'.format(*key,value))
-
-        bmFile.write(");\nblocks\n(\n")
-
-
-        NoCells = 0
-        for bid, (vl, blockName) in enumerate(zip(blocks, blockNames)):
-            edges = [(vl[e[0]],vl[e[1]]) for e in [(0,1),(3,2),(7,6),(4,5),(0,3),(1,2),(5,6),(4,7),(0,4),(1,5),(2,6),(3,7)]]
-            gradingStr = ""
-            for ei in edges:
-                e = edgeInfo[ei]
-                gradingStr+='\n(\n ({:.6g} {:.6g} {:.6g}) ({:.6g} {:.6g} {:.6g}) ({:.6g} {:.6g} {:.6g}) '.format(
-                e["l1"],e["n1"],e["ratio1"],\
-                e["dL"],e["nL"],1,\
-                e["l2"],e["n2"],1/e["ratio2"]) + '\n)'
-            ires = edgeInfo[edges[0]]["N"]
-            jres = edgeInfo[edges[4]]["N"]
-            kres = edgeInfo[edges[8]]["N"]
-
-            NoCells += ires*jres*kres
-            bmFile.write('// block id {} \nhex ({} {} {} {} {} {} {} {}) '.format(bid,*vl) \
-                       + blockName + ' ({} {} {}) '.format(ires,jres,kres)\
-                       + 'edgeGrading (' + gradingStr + '\n)\n' )
-        bmFile.write(');\n\npatches\n(\n')
+            edges.append('    project ({} {} {} {}) {}\n'.format(*key,value))
+        edges.append(");\n")
+
+        hexes = ["blocks\n(\n", *hexLines(blocks, blockNames, N, gradings, '\n)\n'), ");\n"]
+        patches = ['\npatches\n(\n']
         for b in boundaries:
-            bmFile.write('     {} {}\n    (\n'.format(b['type'],b['name'] ))
-            for v in b['faceVerts']:
-                bmFile.write('        ({} {} {} {})\n'.format(*v))
-            bmFile.write('    )\n')
-        bmFile.write(');')
-        bmFile.close()
-        return NoCells
-
-
-    def readHeader(self,dicfile):
-        numberOfFields = 0
-        startLine = False
-        with open(dicfile) as fin:
-            for lidx,line in enumerate(fin):
-                if not numberOfFields:
-                    try:
-                        numberOfFields = int(line)
-                    except ValueError:
-                        pass
-                if '(' in line:
-                    startLine = lidx + 1
-                    break
-        return startLine, numberOfFields
-
-    def readBoundaries(self,files):
-        data = []
-        readingField = False
-        for line in files:
-            if not line.strip():
-                continue
-            if not readingField and line.strip() == '{':
-                readingField = True
-            elif not readingField:
-                temp = dict()
-                temp['name']= line.strip()
-            elif readingField and 'type' in line:
-                temp['type'] = line.strip().split()[1][:-1]
-            elif readingField and 'nFaces' in line:
-                temp['nFaces'] = int(line.strip().split()[1][:-1])
-            elif readingField and 'startFace' in line:
-                temp['startFace'] = int(line.strip().split()[1][:-1])
-            elif readingField and line.strip() == '}':
-                data.append(temp)
-                readingField = False
-            elif not readingField and line.strip() == ')':
-                break
-        return data
-
-    def getPoints(self,faces=None):
-        pointsFile = os.path.join(self.tempdir, 'constant', 'polyMesh', 'points')
-        startLine, numberofLines = self.readHeader(pointsFile)
-        convertfnc1 = lambda x: float(x[1:])
-        convertfnc2 = lambda x:float(x[:-1])
-        with open(pointsFile,'rb') as fin:
-            points = np.genfromtxt(itertools.islice(fin,startLine,startLine+numberofLines),\
-                converters={0:convertfnc1,2:convertfnc2},dtype=float)
-        if faces!=None:
-            pidxs = np.unique(np.ravel(faces))
-            points = points[pidxs]
-        points=points.tolist()
-        return points
-
-    def getFaces(self):
-        facesFile = os.path.join(self.tempdir, 'constant', 'polyMesh', 'faces')
-        startLine, numberofLines = self.readHeader(facesFile)
-        convertfnc1 = lambda x: int(x[2:])
-        convertfnc2 = lambda x: int(x[:-1])
-        with open(facesFile,'rb') as fin:
-            faces = np.genfromtxt(itertools.islice(fin,startLine,startLine+numberofLines),\
-                converters={0:convertfnc1,3:convertfnc2},dtype=int)
-        faces = faces.tolist()
-        return faces
-
-    def getBCFaces(self,internalCells):
-        faces = self.getFaces()
-        bcifaces = faces
-        bcfaces = faces
-        if not internalCells:
-            boundaryFile = os.path.join(self.tempdir, 'constant', 'polyMesh', 'boundary')
-            startLine, boundaries = self.readHeader(boundaryFile)
-            with open(boundaryFile) as fin:
-                fields = self.readBoundaries(itertools.islice(fin,startLine,None))
-            self.fields = fields
-            bcifaces = []
-            bcfaces=[]
-            for bc in sorted(fields, key=lambda k: k['startFace']):
-                bcfaces.extend(faces[bc['startFace']:bc['startFace']+bc['nFaces']])
-            bcifaces = np.array(bcfaces,dtype=int)
-            bcifaces = np.unique(bcifaces.ravel(),return_inverse=True)[1].reshape(bcifaces.shape)
-            bcifaces = bcifaces.astype(int).tolist()
-        return bcfaces,bcifaces
-
-#this is faster
-    def getBCFaces2(self,internalCells):
-        facesFile = os.path.join(self.tempdir, 'constant', 'polyMesh', 'faces')
-        startLine, numberofLines = self.readHeader(facesFile)
-        faces = open(facesFile).readlines()
-        faces = faces[startLine:startLine+numberofLines]
-        subs = lambda s: list(map(int,s.__getitem__(slice(2,-2)).split()))
-        faces = list(map(subs, faces))
-        boundaryFile = os.path.join(self.tempdir, 'constant', 'polyMesh', 'boundary')
-        startLine, boundaries = self.readHeader(boundaryFile)
-        with open(boundaryFile) as fin:
-            fields = self.readBoundaries(itertools.islice(fin,startLine,None))
-        self.fields = fields
-        bcifaces = []
-        bcfaces=[]
-        for bc in sorted(fields, key=lambda k: k['startFace']):
-            bcfaces.extend(faces[bc['startFace']:bc['startFace']+bc['nFaces']])
-        bcifaces = np.array(bcfaces,dtype=int)
-        bcifaces = np.unique(bcifaces.ravel(),return_inverse=True)[1].reshape(bcifaces.shape)
-        bcifaces = bcifaces.astype(int).tolist()
-        return bcfaces,bcifaces
-
-    def runBlockMesh(self):
-        subprocess.call([self.blockMeshbin,'-case',self.tempdir],stdout=subprocess.PIPE)
+            patches.append('     {} {}\n    (\n'.format(b['type'],b['name'] ))
+            patches.extend(formatLines('        ({} {} {} {})\n', b['faceVerts']))
+            patches.append('    )\n')
+        patches.append(');')
+
+        if self.split:
+            self.writtenFiles = []
+            for name, chunks in (('vertices', vertices), ('blocks', hexes), ('patches', patches)):
+                includePath = '{}.{}'.format(self.blockMeshDictPath, name)
+                if writeDictionary(includePath, chunks, self.compress, True):
+                    self.writtenFiles.append(includePath)
+                main.append('#include "{}"\n'.format(os.path.basename(includePath)))
+                if name == 'vertices':
+                    main.extend(edges)
+            if writeDictionary(self.blockMeshDictPath, main, self.compress, True):
+                self.writtenFiles.append(self.blockMeshDictPath)
+        else:
+            writeDictionary(self.blockMeshDictPath, main + vertices + edges + hexes + patches, self.compress)
+            self.writtenFiles = [self.blockMeshDictPath]
+        return int(np.prod(N, axis=1).sum())
+
+
+    def polyMeshPath(self):
+        return os.path.join(self.tempdir, 'constant', 'polyMesh')
+
+    def startBlockMesh(self):
+        # Start blockMesh in the background, None if it is not found
+        if not shutil.which('blockMesh'):
+            return None
+        self.blockMeshbin = 'blockMesh'
+        print('running blockMesh')
+        self.process = BlockMeshProcess([self.blockMeshbin,'-case',self.tempdir])
+        return self.process
+
+    def cancelMesh(self):
+        self.process.cancel()
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def readMesh(self,internalCells=False):
+        # Boundary faces and only their points are read from the polyMesh
+        points, offsets, labels, self.fields = polyMesh.readBoundaryMesh(self.polyMeshPath(), internalCells)
+        bcifaces = polyMesh.faceArray(offsets, labels)
+        shutil.rmtree(self.tempdir)
+        return points, bcifaces
 
     def runMesh(self,runBlockMesh=True,internalCells=False):
         if not shutil.which('blockMesh'):
             return [], []
         if runBlockMesh:
-            self.blockMeshbin = 'blockMesh'
-            print('running blockMesh')
-            self.runBlockMesh()
-        faces, bcifaces=self.getBCFaces2(internalCells)
-        points=self.getPoints(faces)
-        shutil.rmtree(self.tempdir)
-        return points, bcifaces
+            self.startBlockMesh().wait()
+        return self.readMesh(internalCells)
 
     def header(self):
         return \
@@ -240,6 +273,38 @@ writeInterval   1;
 
 
 
+// ************************************************************************* //
+
+'''
+
+    def previewControlDict(self):
+        # controlDict of the preview case. blockMesh writes the polyMesh in
+        # binary format, which is faster to write and to read back than ascii.
+        return \
+        '''
+/*--------------------------------*- C++ -*----------------------------------*/
+
+// File was generated by SwiftBlock, a Blender 3D addon.
+
+FoamFile
+{
+    version     2.0;
+    format      ascii;
+    class       dictionary;
+    object      controlDict;
+}
+// * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * //
+
+deltaT          1;
+
+writeInterval   1;
+
+writeFormat     binary;
+
+writeCompression off;
+
+
+
 // ************************************************************************* //
 
 '''
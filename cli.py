@@ -0,0 +1,168 @@
+# Command line blockMeshDict generation without Blender. Block detection and
+# writing of blockMeshDict only need NumPy.
+#
+# python cli.py blocking.obj -o case
+# python cli.py cases/*.json -j 8
+#
+# The blocking is read from a Wavefront OBJ file (vertices, and edges from
+# lines and faces) or from a JSON file:
+#
+# {"vertices": [[x, y, z], ...],
+#  "edges": [[v0, v1], ...],
+#  "cells": 10,
+#  "edgeParameters": [{"edge": [v0, v1], "cells": 20, "x1": 0.01, "r1": 1.2}, ...],
+#  "patches": [{"name": "inlet", "type": "patch", "faces": [[v0, v1, v2, v3], ...]}, ...]}
+#
+# Only "vertices" and "edges" are required. The cells of an edge apply to all
+# edges in its edge group and grading parameters are given from the first
+# vertex of the edge. Boundary faces not in any patch are written to patch
+# "default" of type wall.
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+
+import numpy as np
+
+if not __package__:
+    # Running as a script: load the add-on modules as a package without
+    # executing __init__.py, which requires Blender
+    import types
+    __package__ = 'swiftBlock'
+    package = types.ModuleType(__package__)
+    package.__path__ = [os.path.dirname(os.path.abspath(__file__))]
+    sys.modules[__package__] = package
+
+from . import blockBuilder
+from . import blockMeshMG
+from . import grading
+
+
+def readObj(filename):
+    verts = []
+    edges = []
+    with open(filename) as fin:
+        for line in fin:
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0] == 'v':
+                verts.append([float(x) for x in parts[1:4]])
+            elif parts[0] in ('l', 'f'):
+                ids = [int(p.split('/')[0]) for p in parts[1:]]
+                ids = [i - 1 if i > 0 else len(verts) + i for i in ids]
+                if parts[0] == 'f':
+                    ids.append(ids[0])
+                edges.extend(zip(ids[:-1], ids[1:]))
+    return {'vertices': verts, 'edges': edges}
+
+def readBlocking(filename):
+    if filename.lower().endswith('.obj'):
+        data = readObj(filename)
+    else:
+        with open(filename) as fin:
+            data = json.load(fin)
+    verts = np.array(data['vertices'], dtype=float).reshape(-1,3)
+    # remove duplicate edges, e.g. shared by two faces in OBJ files
+    edges = []
+    found = set()
+    for e in data['edges']:
+        key = (min(e), max(e))
+        if e[0] != e[1] and key not in found:
+            found.add(key)
+            edges.append([int(e[0]), int(e[1])])
+    return verts, edges, data
+
+def boundaryPatches(face_info, faces_as_list_of_nodes, patches):
+    # Boundary faces have a block only on one side
+    boundaryFaces = []
+    for fid, info in face_info.items():
+        if bool(info['pos']) != bool(info['neg']):
+            boundaryFaces.append(faces_as_list_of_nodes[fid])
+    boundaries = []
+    assigned = dict()
+    for p in patches:
+        boundaries.append({'name':p['name'], 'type':p.get('type', 'patch'), 'faceVerts':[]})
+        for f in p['faces']:
+            assigned[tuple(sorted(f))] = boundaries[-1]
+    default = {'name':'default', 'type':'wall', 'faceVerts':[]}
+    boundaries.append(default)
+    for f in boundaryFaces:
+        assigned.get(tuple(sorted(f)), default)['faceVerts'].append(f)
+    return [b for b in boundaries if b['faceVerts']]
+
+def edgeInfo(verts, edges, edge_group, data):
+    mappingType = 'Geometric MG'
+    parameters = {(min(p['edge']), max(p['edge'])): p for p in data.get('edgeParameters', [])}
+    # cells of an edge group are set by the last edge listed in it
+    groupCells = dict()
+    for p in data.get('edgeParameters', []):
+        key = (min(p['edge']), max(p['edge']))
+        if 'cells' in p and key in edge_group:
+            groupCells[edge_group[key]] = p['cells']
+
+    edgeParameters = []
+    for v0, v1 in edges:
+        key = (min(v0,v1), max(v0,v1))
+        p = dict(parameters.get(key, {}))
+        if p and p['edge'][0] != v0:
+            # parameters were given in the opposite direction
+            p['x1'], p['x2'] = p.get('x2', 0), p.get('x1', 0)
+            p['r1'], p['r2'] = p.get('r2', 1), p.get('r1', 1)
+            p['ratio'] = 1./p.get('ratio', 1)
+        N = p.get('cells', data.get('cells', 10))
+        if key in edge_group:
+            N = groupCells.get(edge_group[key], data.get('cells', 10))
+        L = np.linalg.norm(verts[v1] - verts[v0])
+        edgeParameters.append((p.get('x1', 0), p.get('x2', 0), p.get('r1', 1), p.get('r2', 1), N, p.get('ratio', 1), L))
+    edgeParameters = list(zip(*edgeParameters)) or [[]]*7
+    return grading.edgeGradingArray(mappingType, edges, *edgeParameters)
+
+def writeCase(filename, folder, detection='faceLoops', split=False, compress=False):
+    verts, edges, data = readBlocking(filename)
+    log, blocks, dependent_edges, face_info, all_edges, faces_as_list_of_nodes, edge_group = \
+        blockBuilder.blockFinder(edges, verts, detection=detection)
+    boundaries = boundaryPatches(face_info, faces_as_list_of_nodes, data.get('patches', []))
+    gradings = edgeInfo(verts, edges, edge_group, data)
+    projections = {'vert2surf':dict(), 'edge2surf':dict(), 'face2surf':dict(), 'geo':[]}
+    os.makedirs(folder, exist_ok=True)
+    mesh = blockMeshMG.PreviewMesh(folder, split, compress)
+    cells = mesh.writeBlockMeshDict(verts.tolist(), 1, boundaries, [], gradings, \
+        ['']*len(blocks), blocks, dependent_edges, projections)
+    return filename, mesh.writtenFiles, len(blocks), cells
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write system/blockMeshDict from a blocking in an OBJ or JSON file.')
+    parser.add_argument('input', nargs='+', help='blocking files (.obj or .json)')
+    parser.add_argument('-o', '--output', default='', help='case folder, or parent folder of the cases for several inputs. ' \
+            'By default the input file name without extension.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of blockings processed in parallel')
+    parser.add_argument('--detection', default='faceLoops', choices=('faceLoops', 'hexes', 'check'), help='block detection algorithm')
+    parser.add_argument('--split', action='store_true', help='write vertices, blocks and patches to files included by blockMeshDict ' \
+            'and rewrite only changed files')
+    parser.add_argument('--compress', action='store_true', help='write gzip compressed dictionaries')
+    args = parser.parse_args(argv)
+
+    folders = []
+    for filename in args.input:
+        name = os.path.splitext(filename)[0]
+        if not args.output:
+            folders.append(name)
+        elif len(args.input) == 1:
+            folders.append(args.output)
+        else:
+            folders.append(os.path.join(args.output, os.path.basename(name)))
+
+    if args.jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+            n = len(folders)
+            results = list(executor.map(writeCase, args.input, folders, [args.detection]*n, [args.split]*n, [args.compress]*n))
+    else:
+        results = [writeCase(f, d, args.detection, args.split, args.compress) for f, d in zip(args.input, folders)]
+    for filename, written, blocks, cells in results:
+        print('{}: {} blocks, {} cells, wrote {}'.format(filename, blocks, cells, ', '.join(written) or 'no changed files'))
+
+if __name__ == '__main__':
+    main()
@@ -1,90 +1,62 @@
-from numba import jit
+from numba import njit
 import numpy as np
-
-# @jit(nopython=True)
-def still_coupling(dependent_edges):
-    for es0 in range(len(dependent_edges)):
-        edgeSet0 = dependent_edges[es0]
-        for edge in edgeSet0:
-            for es1 in range(len(dependent_edges)):
-                edgeSet1 = dependent_edges[es1]
-                if edge in edgeSet1 and es0 != es1:
-                    for e in edgeSet0:
-                        edgeSet1.append(e)
-                    dependent_edges.pop(es0)
-                    return True
-    return False
-
-def couple_edges(dependent_edges):
-    while still_coupling(dependent_edges):
-        pass
+from .blockBuilder import csrAdjacency
 
 def cycleFinder(edges,verts):
-    verticesId = np.array(verts)
-    edges = np.array(edges)
-    edgeVisited = np.zeros(len(edges), dtype=bool)
-    faces = [-1] # For Numba the arrays have to contain element
-    facesEdges = [-1]
-    no_edges = 0
-
-    # 50 is the limit of vertices in one edge. Should be enough, maybe too many?
-    v_in_edge = np.ones((len(verticesId),50),dtype=int) * -1
-    for v in verticesId:
-        for eid, e in enumerate(edges):
-            if v in e:
-                v_in_edge[v][np.where(v_in_edge[v] == -1)[0][0]] = eid
-
-    run(verticesId,edges,edgeVisited,faces,facesEdges,no_edges, v_in_edge)
-
-    # Clean double faces
-    faces = np.reshape(faces[1:],(-1,4))
-    temp, u = np.unique(np.sort(faces), axis=0, return_index=True)
-    faces = faces[u]
-    facesP = [list(map(np.asscalar,f)) for f in faces]
-
-    facesEdges = np.reshape(facesEdges[1:],(-1,4))
-    facesEdges = facesEdges[u]
-    facesEdgesP = [list(map(np.asscalar,f)) for f in facesEdges]
-
+    # Same result as blockBuilder.cycleFinder, the quads are enumerated in a
+    # compiled kernel working on the CSR adjacency of the edge graph.
+    offsets, neighbours, edgeIds = csrAdjacency(edges, len(verts))
+    quads = findQuads(offsets.astype(np.int64), neighbours.astype(np.int64), edgeIds.astype(np.int64))
+
+    # Four vertices connected to each other form three different quads,
+    # keep the one with the smallest edges like blockBuilder.cycleFinder
+    keys = np.sort(quads[:,0:4], axis=1)
+    order = np.lexsort(np.hstack((quads[:,7:3:-1], keys[:,::-1])).T)
+    quads = quads[order]
+    keys = keys[order]
+    first = np.ones(len(quads), dtype=bool)
+    first[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+    quads = quads[first]
+
+    facesP = quads[:,0:4].tolist()
+    facesEdgesP = quads[:,4:8].tolist()
     return facesP, facesEdgesP
 
-@jit(nopython=True)
-def run(verticesId,edges,edgeVisited,faces,facesEdges,no_edges, v_in_edge):
-    for v in verticesId:
-        currentCycle = [v]
-        currentCycleEdges = [-1]
-        buildFourEdgeFaces(v, edgeVisited, edges, no_edges, currentCycle, currentCycleEdges, faces, facesEdges, v_in_edge, first=True)
-
-@jit(nopython=True)
-def buildFourEdgeFaces(v, edgeVisited, edges, no_edges, currentCycle, currentCycleEdges, faces, facesEdges, v_in_edge, first=False):
-    for eid in v_in_edge[v]:
-        if eid == -1:
-            break
-        e = edges[eid]
-        if v == e[0]:
-            opposite_v = e[1]
-        elif v == e[1]:
-            opposite_v = e[0]
-        else:
-            continue
-        if not edgeVisited[eid]:
-            no_edges += 1
-            edgeVisited[eid] = True
-            currentCycle.append(opposite_v)
-            if first:
-                currentCycleEdges[0] = eid
-                first = False
-            else:
-                currentCycleEdges.append(eid)
-            if currentCycle[0] == currentCycle[-1]: # First equals last -> we have a face
-                # we are only interested in quads
-                if len(currentCycle) == 5:
-                    faces.extend(currentCycle[0:4])
-                    facesEdges.extend(currentCycleEdges[0:4])
-            else:
-                if no_edges < 4:
-                    buildFourEdgeFaces(opposite_v, edgeVisited, edges, no_edges, currentCycle, currentCycleEdges, faces, facesEdges, v_in_edge)
-            no_edges -= 1
-            currentCycle.pop()
-            currentCycleEdges.pop()
-            edgeVisited[eid] = False
+@njit(cache=True)
+def findQuads(offsets, neighbours, edgeIds):
+    # Each row is a quad m-a-b-c-m followed by its four edges, where m is the
+    # smallest vertex and edge(m,a) < edge(m,c)
+    nverts = len(offsets) - 1
+    quads = np.empty((max(nverts, 16), 8), dtype=np.int64)
+    count = 0
+    edge_to_a = np.full(nverts, -1, dtype=np.int64)
+    for m in range(nverts):
+        for i in range(offsets[m], offsets[m+1]):
+            a = neighbours[i]
+            if a <= m:
+                continue
+            for k in range(offsets[a], offsets[a+1]):
+                edge_to_a[neighbours[k]] = edgeIds[k]
+            for j in range(i+1, offsets[m+1]):
+                c = neighbours[j]
+                if c <= m:
+                    continue
+                for k in range(offsets[c], offsets[c+1]):
+                    b = neighbours[k]
+                    if b > m and edge_to_a[b] != -1:
+                        if count == len(quads):
+                            grown = np.empty((2*len(quads), 8), dtype=np.int64)
+                            grown[:count] = quads[:count]
+                            quads = grown
+                        quads[count,0] = m
+                        quads[count,1] = a
+                        quads[count,2] = b
+                        quads[count,3] = c
+                        quads[count,4] = edgeIds[i]
+                        quads[count,5] = edge_to_a[b]
+                        quads[count,6] = edgeIds[k]
+                        quads[count,7] = edgeIds[j]
+                        count += 1
+            for k in range(offsets[a], offsets[a+1]):
+                edge_to_a[neighbours[k]] = -1
+    return quads[:count]
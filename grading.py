@@ -0,0 +1,420 @@
+import collections
+import json
+import numpy as np
+
+# Edge grading (mapping of cells along block edges). This module does not
+# depend on Blender.
+
+def edgeMapping(edge):
+    if edge["type"] == "Geometric MG":
+        return multiGrading(edge)
+    elif edge["type"] == "Geometric":
+        edge["ratio"] == edge["ratio"]
+        return edge
+
+def multiGrading(edge):
+    eps = 1e-6
+    grading1 = True
+    grading2 = True
+    x1,x2 = edge['x1'], edge['x2']
+    r1,r2 = edge['r1'], edge['r2']
+    N, L = edge['N'], edge['L']
+
+    def both(L,N,x1,x2,r1,r2,dx):
+        n1 = np.log(dx/x1) / np.log(r1) + 1
+        n2 = np.log(dx/x2) / np.log(r2) + 1
+        l1 = x1*(1-r1**n1)/(1-r1)
+        l2 = x2*(1-r2**n2)/(1-r2)
+        Lapprox = l1 + l2 + (N - n1 - n2-1)*dx
+        err = (L-Lapprox)
+        return err,(n1,n2,l1,l2)
+
+    def oneside(L,N,x,r,dx):
+        n = np.log(dx/x) / np.log(r) + 1
+        l = x*(1-r**n)/(1-r)
+        Lapprox = l + (N - n)*dx
+        err = (L-Lapprox)
+        return err,(n,l)
+
+    if abs(x1) < eps or (abs(r1) - 1) < eps:
+        grading1 = False
+    if abs(x2) < eps or (abs(r2) - 1) < eps:
+        grading2 = False
+
+    if not grading1 and not grading2:
+        edge["l1"], edge["l2"] = 0,0
+        edge["n1"], edge["n2"] = 0,0
+        edge["ratio1"], edge["ratio2"] = 1,1
+        edge["dL"], edge["nL"] = 1, N
+        return edge
+
+    elif grading1 and not grading2:
+        l1 = x1*(1-r1**N)/(1-r1)
+        if l1 < L:
+            n1 = np.log(1-l1/x1*(1-r1))/np.log(r1)
+            n1 += 1
+            dx = x1*r1**n1
+            edge["l1"], edge["l2"] = L,0
+            edge["n1"], edge["n2"] = n1,0
+            edge["ratio1"], edge["ratio2"] = dx/x1,1
+            edge["dL"], edge["nL"] = 0, 0
+            return edge
+        approx = oneside
+        x,r = x1,r1
+        dx = L/N #initial guess
+        parameters = [L,N,x,r,dx]
+    elif not grading1 and grading2:
+        l2 = x2*(1-r2**N)/(1-r2)
+        if l2 < L:
+            n2 = np.log(1-l2/x2*(1-r2))/np.log(r2)
+            n2 += 1
+            dx = x2*r2**n2
+            edge["l1"], edge["l2"] = 0,L
+            edge["n1"], edge["n2"] = 0,n2
+            edge["ratio1"], edge["ratio2"] = 1,dx/x2
+            edge["dL"], edge["nL"] = 0, 0
+            return edge
+        approx = oneside
+        x,r = x2,r2
+        dx = L/N
+        parameters = [L,N,x,r,dx]
+    else:
+        n1 = (np.log(x2/x1)+N*np.log(r2))/np.log(r1*r2)
+        n1 = int(n1+0.5)
+        n2 = N-n1-1
+        l1 = x1*((1-r1**n1)/(1-r1))
+        l2 = x2*((1-r2**n2)/(1-r2))
+        if (l1+l2) < L:
+            n1 = np.log((L*(1-r1)*(1-r2)-x1-x2+x1*r2+x2*r1)/(-2*x1+x1*r1+x1*r2))/np.log(r1)
+            n2 = np.log(x1/x2*r1**n1)/np.log(r2)
+            l1 = x1*((1-r1**n1)/(1-r1))
+            l2 = x2*((1-r2**n2)/(1-r2))
+            dx = x1*r1**n1
+            n1 += 1
+            n2 += 1
+            edge["l1"], edge["l2"] = l1,l2
+            edge["n1"], edge["n2"] = n1,n2
+            edge["ratio1"], edge["ratio2"] = dx/x1, dx/x2
+            edge["dL"], edge["nL"] = 0, 0
+            return edge
+            # l2 = (x2-x1+L-L*r1)/(2-r2-r1)
+            # l1 = L - l2
+            # n1 = np.log(1-l1/x1*(1-r1))/np.log(r1)
+            # n2 = N-n1
+        approx = both
+        dx = L/N
+        parameters = [L,N,x1,x2,r1,r2,dx]
+
+
+    Lapprox = 0.0
+    err = 1.0
+    count = 0
+
+    err,pars=approx(*parameters)
+    dx_old = dx
+    err_old = err
+    dx = dx*1.2*1e-10 # small perturbation
+    parameters[-1] = dx
+    err,pars=approx(*parameters)
+
+    while abs(err)>1e-12 and count < 1000:
+        dx_temp = dx
+        derr = (err - err_old)/(dx - dx_old)
+        dx = dx - err/derr
+        dx_old = dx_temp
+        err_old = err
+        parameters[-1] = dx
+        err, out = approx(*parameters)
+        count = count+1
+
+    if grading1 and not grading2:
+        n1,l1 = out
+        ratio1 = dx/x1
+        n2,l2,ratio2 = 0,0,1
+    elif not grading1 and grading2:
+        n2,l2 = out
+        ratio2 = dx/x2
+        n1,l1,ratio1 = 0,0,1
+    else:
+        n1,n2,l1,l2 = out
+        ratio1 = dx/x1
+        ratio2 = dx/x2
+
+    if (dx < x1 and abs(x1) > eps) or (dx < x2 and abs(x2) > eps):
+        dx = x1
+        l1, l2 = 0,0
+        n1, n2 = 0,0
+        ratio1, ratio2 = 1, 1
+
+    dL = L-l1-l2
+    nL = N-n1-n2
+    dx = dL/nL
+    edge['l1'], edge['l2'] = l1, l2
+    edge['n1'], edge['n2'] = n1, n2
+    edge['ratio1'], edge['ratio2'] = ratio1, ratio2
+    edge['dL'], edge['nL'] = dL, nL
+    return edge
+
+def getNodes(x1,x2,r1,r2,L,dx):
+    n1 = np.log(dx/x1)/np.log(r1) + 1
+    n2 = np.log(dx/x1)/np.log(r1) + 1
+    l1 = x1*(1-r1**n1)/(1-r1)
+    l2 = x2*(1-r2**n2)/(1-r2)
+    if (l1+l2) > L:
+        n1 = np.log((L*(1-r1)*(1-r2)-x1-x2+x1*r2+x2*r1)/(-2*x1+x1*r1+x1*r2))/np.log(r1)
+        n1 = int(n1+0.5)+1
+        n2 = np.log(x1/x2*r1**n1)/np.log(r2)
+        n2 = int(n2+0.5)
+        l1 = x1*((1-r1**n1)/(1-r1))
+        l2 = x2*((1-r2**n2)/(1-r2))
+        dx = x1*r1**n1
+        return n1+n2
+    else:
+        return n1+n2+(L-l1-l2)/dx
+
+def edgeGradings(mappingType, x1, x2, r1, r2, N, ratio, L):
+    # Grading of an edge in both directions. The parameters are given from
+    # the start of the edge, zero values are replaced by defaults.
+    be = dict()
+    be["type"] = mappingType
+    be["x1"] = x1
+    be["x2"] = x2
+    be["r1"] = r1
+    be["r2"] = r2
+    be["N"] = N
+    be["ratio"] = ratio
+    be["L"] = L
+    if not be["N"]:
+        be["N"] = 10
+    if not be["r1"]:
+        be["r1"] = 1.
+    if not be["r2"]:
+        be["r2"] = 1.
+    if not be["ratio"]:
+        be["ratio"] = 1
+    be = edgeMapping(be)
+    reverse = dict(be)
+    reverse["x1"],reverse["x2"] = reverse["x2"],reverse["x1"]
+    reverse["r1"],reverse["r2"] = reverse["r2"],reverse["r1"]
+    reverse["ratio"] = 1./reverse["ratio"]
+    reverse = edgeMapping(reverse)
+    return be, reverse
+
+def multiGradings(x1, x2, r1, r2, N, L):
+    # multiGrading for arrays of edges at once. Returns a dict of arrays with
+    # the values multiGrading sets. The secant iteration of all edges runs
+    # simultaneously, each edge stops when its own error is small enough.
+    eps = 1e-6
+    x1, x2, r1, r2, L = [np.array(a, dtype=float, ndmin=1) for a in (x1, x2, r1, r2, L)]
+    N = np.array(N, dtype=int, ndmin=1)
+    x1, x2, r1, r2, N, L = np.broadcast_arrays(x1, x2, r1, r2, N, L)
+    grading1 = ~((np.abs(x1) < eps) | ((np.abs(r1) - 1) < eps))
+    grading2 = ~((np.abs(x2) < eps) | ((np.abs(r2) - 1) < eps))
+    only1 = grading1 & ~grading2
+    only2 = ~grading1 & grading2
+    both = grading1 & grading2
+
+    l1, l2 = np.zeros(len(L)), np.zeros(len(L))
+    n1, n2 = np.zeros(len(L)), np.zeros(len(L))
+    ratio1, ratio2 = np.ones(len(L)), np.ones(len(L))
+    dL, nL = np.ones(len(L)), N.astype(float)
+
+    with np.errstate(all='ignore'):
+        # Edges graded from one side only, x and r of the graded side
+        x = np.where(only1, x1, x2)
+        r = np.where(only1, r1, r2)
+        l = x*(1-r**N)/(1-r)
+        oneEarly = (only1 | only2) & (l < L)
+        n = np.log(1-l/x*(1-r))/np.log(r)
+        n += 1
+        dx = x*r**n
+        l1 = np.where(oneEarly & only1, L, l1)
+        l2 = np.where(oneEarly & only2, L, l2)
+        n1 = np.where(oneEarly & only1, n, n1)
+        n2 = np.where(oneEarly & only2, n, n2)
+        ratio1 = np.where(oneEarly & only1, dx/x, ratio1)
+        ratio2 = np.where(oneEarly & only2, dx/x, ratio2)
+
+        # Edges graded from both sides
+        m1 = (np.log(x2/x1)+N*np.log(r2))/np.log(r1*r2)
+        m1 = np.trunc(m1+0.5)
+        m2 = N-m1-1
+        k1 = x1*((1-r1**m1)/(1-r1))
+        k2 = x2*((1-r2**m2)/(1-r2))
+        bothEarly = both & ((k1+k2) < L)
+        m1 = np.log((L*(1-r1)*(1-r2)-x1-x2+x1*r2+x2*r1)/(-2*x1+x1*r1+x1*r2))/np.log(r1)
+        m2 = np.log(x1/x2*r1**m1)/np.log(r2)
+        k1 = x1*((1-r1**m1)/(1-r1))
+        k2 = x2*((1-r2**m2)/(1-r2))
+        dx = x1*r1**m1
+        m1 += 1
+        m2 += 1
+        l1 = np.where(bothEarly, k1, l1)
+        l2 = np.where(bothEarly, k2, l2)
+        n1 = np.where(bothEarly, m1, n1)
+        n2 = np.where(bothEarly, m2, n2)
+        ratio1 = np.where(bothEarly, dx/x1, ratio1)
+        ratio2 = np.where(bothEarly, dx/x2, ratio2)
+        dL = np.where(oneEarly | bothEarly, 0, dL)
+        nL = np.where(oneEarly | bothEarly, 0, nL)
+
+        # Solve the cell size dx at the middle of the other graded edges
+        solve = np.flatnonzero((grading1 | grading2) & ~oneEarly & ~bothEarly)
+        def approx(i, dx):
+            # error of the edge length and the lengths and cell counts of
+            # the graded parts for edges i
+            n = np.log(dx/x[i]) / np.log(r[i]) + 1
+            l = x[i]*(1-r[i]**n)/(1-r[i])
+            err1 = L[i]-(l + (N[i] - n)*dx)
+            b1 = np.log(dx/x1[i]) / np.log(r1[i]) + 1
+            b2 = np.log(dx/x2[i]) / np.log(r2[i]) + 1
+            c1 = x1[i]*(1-r1[i]**b1)/(1-r1[i])
+            c2 = x2[i]*(1-r2[i]**b2)/(1-r2[i])
+            err2 = L[i]-(c1 + c2 + (N[i] - b1 - b2-1)*dx)
+            return np.where(both[i], err2, err1), np.where(both[i], b1, n), np.where(both[i], b2, n), \
+                   np.where(both[i], c1, l), np.where(both[i], c2, l)
+
+        dx = L[solve]/N[solve]
+        err_old = approx(solve, dx)[0]
+        dx_old = dx
+        dx = dx*1.2*1e-10 # small perturbation
+        err, s1, s2, t1, t2 = approx(solve, dx)
+        active = np.flatnonzero(np.abs(err) > 1e-12)
+        count = 0
+        while len(active) and count < 1000:
+            dx_temp = dx[active]
+            derr = (err[active] - err_old[active])/(dx[active] - dx_old[active])
+            dx[active] = dx[active] - err[active]/derr
+            dx_old[active] = dx_temp
+            err_old[active] = err[active]
+            err[active], s1[active], s2[active], t1[active], t2[active] = approx(solve[active], dx[active])
+            active = active[np.abs(err[active]) > 1e-12]
+            count = count+1
+
+        i = solve
+        n1[i] = np.where(only2[i], 0, s1)
+        n2[i] = np.where(only1[i], 0, s2)
+        l1[i] = np.where(only2[i], 0, t1)
+        l2[i] = np.where(only1[i], 0, t2)
+        ratio1[i] = np.where(only2[i], 1, dx/x1[i])
+        ratio2[i] = np.where(only1[i], 1, dx/x2[i])
+        reset = ((dx < x1[i]) & (np.abs(x1[i]) > eps)) | ((dx < x2[i]) & (np.abs(x2[i]) > eps))
+        l1[i[reset]], l2[i[reset]] = 0, 0
+        n1[i[reset]], n2[i[reset]] = 0, 0
+        ratio1[i[reset]], ratio2[i[reset]] = 1, 1
+        dL[i] = L[i]-l1[i]-l2[i]
+        nL[i] = N[i]-n1[i]-n2[i]
+    return {'l1':l1, 'l2':l2, 'n1':n1, 'n2':n2, 'ratio1':ratio1, 'ratio2':ratio2, 'dL':dL, 'nL':nL}
+
+def bothGradings(x1, x2, r1, r2, N, L):
+    # Solved values of multiGradings in both directions of the edges. Edges
+    # graded from one side or not at all are solved once and the reverse
+    # direction is obtained by swapping the sides. Rounding of the cell
+    # counts makes edges graded from both sides asymmetric, they are solved
+    # again in the reverse direction.
+    forward = multiGradings(x1, x2, r1, r2, N, L)
+    reverse = dict()
+    for k1, k2 in (('l1','l2'), ('n1','n2'), ('ratio1','ratio2'), ('dL','dL'), ('nL','nL')):
+        reverse[k1], reverse[k2] = forward[k2].copy(), forward[k1].copy()
+    eps = 1e-6
+    both = np.flatnonzero((np.abs(x1) >= eps) & ((np.abs(r1) - 1) >= eps) & (np.abs(x2) >= eps) & ((np.abs(r2) - 1) >= eps))
+    if len(both):
+        solved = multiGradings(x2[both], x1[both], r2[both], r1[both], N[both], L[both])
+        for key, value in solved.items():
+            reverse[key][both] = value
+    return forward, reverse
+
+class GradingCache():
+    # Least recently used cache of solved gradings. Edges are identified by
+    # their parameters rounded to 7 significant digits, the precision of
+    # vertex coordinates in Blender, so that edges differing only by
+    # rounding noise share the entry. The cache can be saved as a string.
+    keys = ('l1','l2','n1','n2','ratio1','ratio2','dL','nL')
+
+    def __init__(self, data='', maxsize=20000):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if data:
+            self.entries.update(json.loads(data))
+
+    def dumps(self):
+        return json.dumps(list(self.entries.items()))
+
+    def gradings(self, x1, x2, r1, r2, N, L):
+        # Same as bothGradings, only edges not found in the cache are solved
+        keys = ['{} {:.7g} {:.7g} {:.7g} {:.7g} {:.7g}'.format(*p) for p in zip(N.tolist(), x1.tolist(), x2.tolist(), r1.tolist(), r2.tolist(), L.tolist())]
+        missing = dict()
+        for i, key in enumerate(keys):
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            elif key not in missing:
+                missing[key] = i
+            else:
+                self.hits += 1
+        self.misses += len(missing)
+        if missing:
+            i = np.array(list(missing.values()), dtype=int)
+            forward, reverse = bothGradings(x1[i], x2[i], r1[i], r2[i], N[i], L[i])
+            values = np.column_stack([forward[k] for k in self.keys] + [reverse[k] for k in self.keys])
+            for key, v in zip(missing, values.tolist()):
+                self.entries[key] = v
+        values = np.array([self.entries[key] for key in keys], dtype=float).reshape(-1, 2*len(self.keys))
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        forward = dict((k, values[:,j]) for j, k in enumerate(self.keys))
+        reverse = dict((k, values[:,j+len(self.keys)]) for j, k in enumerate(self.keys))
+        return forward, reverse
+
+# Gradings of directed edges (v0, v1) as a structured array
+edgeDtype = [('v0', int), ('v1', int), ('N', int), ('x1', float), ('x2', float), ('r1', float), ('r2', float), \
+             ('ratio', float), ('L', float), ('l1', float), ('l2', float), ('n1', float), ('n2', float), \
+             ('ratio1', float), ('ratio2', float), ('dL', float), ('nL', float)]
+
+def edgeGradingArray(mappingType, edges, x1, x2, r1, r2, N, ratio, L, cache=None):
+    # edgeGradings for arrays of edges (E,2). Returns a structured array of
+    # edgeDtype with both directions of the edges, sorted by (v0, v1). For
+    # each edge (a, b) in edges, row (v0, v1) = (b, a) holds the grading as
+    # given and row (a, b) the reversed one. With a GradingCache, only edges
+    # missing from it are solved.
+    edges = np.array(edges, dtype=int).reshape(-1,2)
+    x1, x2, r1, r2, ratio, L = [np.array(a, dtype=float, ndmin=1) for a in (x1, x2, r1, r2, ratio, L)]
+    N = np.array(N, dtype=int, ndmin=1)
+    N = np.where(N == 0, 10, N)
+    r1 = np.where(r1 == 0, 1., r1)
+    r2 = np.where(r2 == 0, 1., r2)
+    ratio = np.where(ratio == 0, 1., ratio)
+
+    if mappingType != "Geometric MG":
+        forward, reverse = dict(), dict()
+        gradings = [edgeGradings(mappingType, *p) for p in zip(x1.tolist(), x2.tolist(), r1.tolist(), r2.tolist(), \
+                    N.tolist(), ratio.tolist(), L.tolist())]
+        for key in GradingCache.keys:
+            forward[key] = np.array([g[0].get(key, 0) for g in gradings], dtype=float)
+            reverse[key] = np.array([g[1].get(key, 0) for g in gradings], dtype=float)
+    elif cache is None:
+        forward, reverse = bothGradings(x1, x2, r1, r2, N, L)
+    else:
+        forward, reverse = cache.gradings(x1, x2, r1, r2, N, L)
+    forward.update({'v0':edges[:,1], 'v1':edges[:,0], 'x1':x1, 'x2':x2, 'r1':r1, 'r2':r2, 'N':N, 'ratio':ratio, 'L':L})
+    reverse.update({'v0':edges[:,0], 'v1':edges[:,1], 'x1':x2, 'x2':x1, 'r1':r2, 'r2':r1, 'N':N, 'ratio':1./ratio, 'L':L})
+
+    edgeInfo = np.empty(2*len(edges), dtype=edgeDtype)
+    for name in edgeInfo.dtype.names:
+        edgeInfo[name] = np.concatenate((forward[name], reverse[name]))
+    return edgeInfo[np.lexsort((edgeInfo['v1'], edgeInfo['v0']))]
+
+def edgeRows(edgeInfo, edges):
+    # Rows of the directed edges (E,2) in an array from edgeGradingArray
+    edges = np.array(edges, dtype=int).reshape(-1,2)
+    n = max(edgeInfo['v1'].max(initial=0), edges[:,1].max(initial=0)) + 1
+    keys = edgeInfo['v0']*n + edgeInfo['v1']
+    wanted = edges[:,0]*n + edges[:,1]
+    rows = np.searchsorted(keys, wanted)
+    found = rows < len(keys)
+    found[found] = keys[rows[found]] == wanted[found]
+    if not found.all():
+        raise KeyError('No grading for edges {}'.format(edges[~found].tolist()))
+    return rows
@@ -0,0 +1,211 @@
+# Polylines of block edges along the edges of a geometry object. Block
+# vertices are snapped to geometry vertices and edges with a spatial grid,
+# and the polylines are the shortest paths between the snapped vertices.
+# Only NumPy is required.
+
+import concurrent.futures
+import heapq
+import multiprocessing
+import sys
+
+import numpy as np
+
+# Paths are searched in forked worker processes if there are at least
+# poolSources sources and poolEdges edges
+poolSources = 32
+poolEdges = 10000
+# Edge graph of the worker processes
+workerGraph = None
+
+
+class SpatialGrid():
+    # Uniform grid of cubic cells of size h. Each box (lo, hi) is stored in
+    # all cells it overlaps, so that the boxes containing a point are found
+    # among the boxes of its cell. Boxes overlapping more than maxCells cells
+    # are checked for every point instead.
+    maxCells = 512
+
+    def __init__(self, lo, hi, h):
+        self.h = h
+        self.origin = lo.min(axis=0) if len(lo) else np.zeros(3)
+        cmin = self.cell(lo)
+        extent = self.cell(hi) - cmin + 1
+        ncells = np.prod(extent, axis=1)
+        large = ncells > self.maxCells
+        self.large = np.flatnonzero(large)
+        ncells[large] = 0
+
+        ids = np.repeat(np.arange(len(lo)), ncells)
+        local = np.arange(ncells.sum()) - np.repeat(np.cumsum(ncells) - ncells, ncells)
+        extent = extent[ids]
+        offset = np.column_stack((local % extent[:,0], local // extent[:,0] % extent[:,1], local // (extent[:,0]*extent[:,1])))
+        keys = self.key(cmin[ids] + offset)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.ids = ids[order]
+
+    def cell(self, points):
+        return np.floor((points - self.origin)/self.h).astype(np.int64)
+
+    def key(self, cells):
+        # Hash of the cells, collisions only add candidates
+        return (cells[...,0]*73856093) ^ (cells[...,1]*19349663) ^ (cells[...,2]*83492791)
+
+    def query(self, point):
+        # Ids of the boxes which may contain point, ascending
+        key = self.key(self.cell(np.asarray(point, dtype=float)))
+        start, end = np.searchsorted(self.keys, [key, key+1])
+        return np.union1d(self.ids[start:end], self.large)
+
+def gridSize(lengths, tol):
+    # Cell size of a spatial grid for edges of lengths
+    return max(np.median(lengths) if len(lengths) else 0., 100*tol, 1e-12)
+
+def onEdge(point, A, B, tol):
+    # Points on the segments A-B within tol, as in the triangle inequality
+    eps = np.linalg.norm(A - B, axis=1) - np.linalg.norm(point - B, axis=1) - np.linalg.norm(A - point, axis=1)
+    return np.abs(eps) < tol
+
+def snapVertices(verts, geoVerts, geoEdges, tol=1e-6):
+    # Snap block vertices to the geometry. A vertex which is not within tol
+    # of a geometry vertex and lies on a geometry edge is added to the
+    # geometry by splitting the first such edge in two. Returns the geometry
+    # vertices and edges after splitting, and the geometry vertex of each
+    # snapped block vertex.
+    verts = np.asarray(verts, dtype=float).reshape(-1,3)
+    geoVerts = np.asarray(geoVerts, dtype=float).reshape(-1,3)
+    geoEdges = np.asarray(geoEdges, dtype=int).reshape(-1,2)
+    nGeoVerts = len(geoVerts)
+    coords = np.vstack((geoVerts, np.empty((len(verts),3))))
+    edges = geoEdges.tolist()
+    A = geoVerts[geoEdges[:,0]]
+    B = geoVerts[geoEdges[:,1]]
+    h = gridSize(np.linalg.norm(A - B, axis=1), tol)
+    vertGrid = SpatialGrid(geoVerts - tol, geoVerts + tol, h)
+    edgeGrid = SpatialGrid(np.minimum(A, B) - tol, np.maximum(A, B) + tol, h)
+    # Geometry edge of each edge, and the edges which are pieces of each
+    # split geometry edge
+    original = list(range(len(edges)))
+    pieces = dict()
+
+    def nearVertex(v, n):
+        # First of the n first geometry vertices within tol of v, or None
+        near = vertGrid.query(v)
+        near = near[np.linalg.norm(coords[near] - v, axis=1) < tol]
+        if len(near):
+            return int(near[0])
+        added = np.flatnonzero(np.linalg.norm(coords[nGeoVerts:n] - v, axis=1) < tol)
+        return nGeoVerts + int(added[0]) if len(added) else None
+
+    n = nGeoVerts
+    for v in verts:
+        if nearVertex(v, n) is not None:
+            continue
+        candidates = []
+        for geid in edgeGrid.query(v).tolist():
+            candidates.extend(pieces.get(geid, [geid]))
+        if not candidates:
+            continue
+        candidates = np.sort(candidates)
+        ends = np.array([edges[geid] for geid in candidates.tolist()])
+        found = np.flatnonzero(onEdge(v, coords[ends[:,0]], coords[ends[:,1]], tol))
+        if len(found):
+            # Put the vertex on the edge by splitting it in two
+            geid = int(candidates[found[0]])
+            coords[n] = v
+            edges.append([edges[geid][1], n])
+            edges[geid][1] = n
+            original.append(original[geid])
+            pieces.setdefault(original[geid], [original[geid]]).append(len(edges) - 1)
+            n += 1
+
+    snapped = dict()
+    for vid, v in enumerate(verts):
+        gvid = nearVertex(v, n)
+        if gvid is not None:
+            snapped[vid] = gvid
+    return coords[:n], np.array(edges, dtype=int).reshape(-1,2), snapped
+
+def edgeGraph(coords, edges):
+    # Neighbours of the vertices and the lengths of the edges to them, as
+    # offsets into lists of neighbours and lengths
+    edges = np.asarray(edges, dtype=int).reshape(-1,2)
+    both = np.vstack((edges, edges[:,::-1]))
+    both = both[np.argsort(both[:,0], kind='stable')]
+    offsets = np.searchsorted(both[:,0], np.arange(len(coords)+1))
+    lengths = np.linalg.norm(coords[both[:,0]] - coords[both[:,1]], axis=1)
+    return offsets.tolist(), both[:,1].tolist(), lengths.tolist()
+
+def shortestPaths(graph, source, targets):
+    # Dijkstra's shortest paths along the edges from source to the targets,
+    # None if a target cannot be reached. Stops when all targets are found.
+    offsets, neighbours, lengths = graph
+    heappush, heappop = heapq.heappush, heapq.heappop
+    distance = [float('inf')]*(len(offsets) - 1)
+    distance[source] = 0.
+    previous = dict()
+    found = bytearray(len(offsets) - 1)
+    remaining = set(targets)
+    heap = [(0., source)]
+    while heap and remaining:
+        d, v = heappop(heap)
+        if found[v]:
+            continue
+        found[v] = 1
+        remaining.discard(v)
+        for i in range(offsets[v], offsets[v+1]):
+            w = neighbours[i]
+            dw = d + lengths[i]
+            if dw < distance[w]:
+                distance[w] = dw
+                previous[w] = v
+                heappush(heap, (dw, w))
+
+    paths = []
+    for t in targets:
+        if not found[t]:
+            paths.append(None)
+            continue
+        path = [t]
+        while path[-1] != source:
+            path.append(previous[path[-1]])
+        paths.append(path[::-1])
+    return paths
+
+def setWorkerGraph(graph):
+    global workerGraph
+    workerGraph = graph
+
+def workerPaths(job):
+    return shortestPaths(workerGraph, *job)
+
+def polyLinePaths(coords, edges, pairs, processes=1):
+    # Shortest paths between the vertex pairs (source, target), in the
+    # order of pairs. One search per source finds the paths to all its
+    # targets. With processes > 1 and large enough graphs, the sources are
+    # searched in a pool of forked processes.
+    graph = edgeGraph(coords, edges)
+    sources = dict()
+    for i, (source, target) in enumerate(pairs):
+        sources.setdefault(source, []).append(i)
+    jobs = [(source, [pairs[i][1] for i in ids]) for source, ids in sources.items()]
+
+    fork = 'fork' in multiprocessing.get_all_start_methods() and sys.platform != 'darwin'
+    if processes > 1 and fork and len(jobs) >= poolSources and len(edges) >= poolEdges:
+        with concurrent.futures.ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork'), \
+                initializer=setWorkerGraph, initargs=(graph,)) as executor:
+            results = list(executor.map(workerPaths, jobs, chunksize=max(1, len(jobs)//(4*processes))))
+    else:
+        results = [shortestPaths(graph, *job) for job in jobs]
+
+    paths = [None]*len(pairs)
+    for ids, sourcePaths in zip(sources.values(), results):
+        for i, path in zip(ids, sourcePaths):
+            paths[i] = path
+    return paths
+
+def polyLineString(points):
+    # Points of a polyline formatted as (x y z)(x y z)..., and its length
+    points = np.asarray(points, dtype=float).reshape(-1,3)
+    length = float(np.linalg.norm(np.diff(points, axis=0), axis=1).sum())
+    return ('({} {} {})'*len(points)).format(*points.ravel().tolist()), length
@@ -0,0 +1,219 @@
+# Reader of the OpenFOAM polyMesh files points, faces and boundary written
+# by blockMesh, in ascii or binary format. The files are memory-mapped and
+# the lists are converted to NumPy arrays in bulk. Only NumPy is required.
+
+import gzip
+import mmap
+import os
+import re
+
+import numpy as np
+
+headerPattern = re.compile(rb'FoamFile\s*\{(.*?)\}', re.S)
+entryPattern = re.compile(rb'(\w+)\s+("[^"]*"|[^;]*);')
+dictionaryPattern = re.compile(rb'([^\s{}();]+)\s*\{([^}]*)\}')
+# Size of a list and its opening parenthesis at the start of a line
+listPattern = re.compile(rb'^\s*(\d+)\s*\(', re.M)
+# Parentheses are replaced by spaces before ascii lists are parsed
+parentheses = bytes.maketrans(b'()', b'  ')
+# Bytes of ascii lists scanned at once
+chunkSize = 1 << 22
+
+def openFile(path):
+    # Memory-mapped content of path, or the decompressed content of path.gz
+    if not os.path.isfile(path) and os.path.isfile(path + '.gz'):
+        with gzip.open(path + '.gz', 'rb') as fin:
+            return fin.read()
+    with open(path, 'rb') as fin:
+        if not os.fstat(fin.fileno()).st_size:
+            return b''
+        return mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+def readHeader(data):
+    # Entries of the FoamFile dictionary and the position after it
+    m = headerPattern.search(data)
+    if not m:
+        return dict(), 0
+    header = dict((k.decode(), v.strip().strip(b'"').decode()) for k, v in entryPattern.findall(m.group(1)))
+    return header, m.end()
+
+def dataTypes(header):
+    # Label and scalar types of binary files, e.g. arch "LSB;label=32;scalar=64"
+    arch = header.get('arch', '')
+    order = '>' if 'MSB' in arch else '<'
+    label = re.search(r'label=(\d+)', arch)
+    scalar = re.search(r'scalar=(\d+)', arch)
+    labelType = np.dtype('{}i{}'.format(order, int(label.group(1))//8 if label else 4))
+    scalarType = np.dtype('{}f{}'.format(order, int(scalar.group(1))//8 if scalar else 8))
+    return labelType, scalarType
+
+def skipLines(data, pos, n, end):
+    # Position after the next n newlines from pos, counting the newlines in
+    # chunks of chunkSize bytes
+    while n:
+        stop = min(pos + chunkSize, end)
+        if stop <= pos:
+            raise ValueError('List ended before line found')
+        block = data[pos:stop]
+        count = block.count(b'\n')
+        if count >= n:
+            return pos + int(np.flatnonzero(np.frombuffer(block, np.uint8) == 10)[n-1]) + 1
+        n -= count
+        pos = stop
+    return pos
+
+def listStart(data, start):
+    m = listPattern.search(data, start)
+    if not m:
+        raise ValueError('No list found')
+    return int(m.group(1)), m.end()
+
+def listEnd(data, begin, count, dtype, width, binary):
+    # Position of the closing parenthesis of a list starting at begin
+    if binary:
+        return begin + count*width*dtype.itemsize
+    return data.find(b')', begin) if not count else data.find(b'\n)', begin) + 1
+
+def readList(data, start, dtype, width=1, binary=False, first=0, last=None):
+    # Items first to last of the first list after start, width values per
+    # item, and the position after the list. Only the lines of these items
+    # of ascii lists are parsed.
+    count, begin = listStart(data, start)
+    last = count if last is None else last
+    end = listEnd(data, begin, count, dtype, width, binary)
+    if binary:
+        values = np.frombuffer(data, dtype, (last-first)*width, begin + first*width*dtype.itemsize)
+        return values, end + 1
+    # Items are on separate lines after the line of the opening parenthesis
+    lineStart = skipLines(data, begin, first+1, end) if count else begin
+    lineEnd = end if last == count else skipLines(data, lineStart, last-first, end)
+    values = np.fromstring(bytes(data[lineStart:lineEnd]).translate(parentheses), dtype.newbyteorder('='), sep=' ')
+    if values.size != (last-first)*width:
+        raise ValueError('Expected {} values, found {}'.format((last-first)*width, values.size))
+    return values, end + 1
+
+def readRows(data, start, dtype, width, rows, binary=False):
+    # Sorted rows of the first list after start in one pass. Ascii lists are
+    # parsed in chunks of chunkSize bytes, keeping only the values of rows.
+    count, begin = listStart(data, start)
+    if binary:
+        return np.frombuffer(data, dtype, count*width, begin).reshape(-1,width)[rows]
+    end = listEnd(data, begin, count, dtype, width, binary)
+    values = np.empty((len(rows), width), dtype.newbyteorder('='))
+    pos = skipLines(data, begin, 1, end)
+    line = 0
+    done = 0
+    while done < len(rows):
+        stop = data.rfind(b'\n', pos, min(pos + chunkSize, end)) + 1
+        if stop <= pos:
+            raise ValueError('List ended before row {}'.format(rows[done]))
+        block = bytes(data[pos:stop])
+        n = block.count(b'\n')
+        wanted = rows[done:done + np.searchsorted(rows[done:], line + n)]
+        if len(wanted):
+            chunk = np.fromstring(block.translate(parentheses), values.dtype, sep=' ').reshape(-1,width)
+            values[done:done+len(wanted)] = chunk[wanted - line]
+            done += len(wanted)
+        line += n
+        pos = stop
+    return values
+
+def readPoints(path, rows=None):
+    # Points (N,3), or only the points of the sorted point ids rows
+    data = openFile(path)
+    header, start = readHeader(data)
+    labelType, scalarType = dataTypes(header)
+    binary = header.get('format') == 'binary'
+    if rows is not None:
+        return readRows(data, start, scalarType, 3, np.asarray(rows, dtype=int), binary).astype(float)
+    values, end = readList(data, start, scalarType, 3, binary)
+    return values.astype(float).reshape(-1,3)
+
+def readFaces(path, first=0, last=None):
+    # Faces first to last, by default all, as offsets (F+1) into their
+    # point labels. Only the lines of these faces of ascii files are parsed.
+    data = openFile(path)
+    header, start = readHeader(data)
+    labelType, scalarType = dataTypes(header)
+    binary = header.get('format') == 'binary'
+    if header.get('class') == 'faceCompactList':
+        last = listStart(data, start)[0] - 1 if last is None else last
+        offsets, end = readList(data, start, labelType, 1, binary, first, last+1)
+        offsets = offsets.astype(int)
+        labels, end = readList(data, end, labelType, 1, binary, offsets[0], offsets[-1])
+        return offsets - offsets[0], labels.astype(int)
+    if binary:
+        raise ValueError('Binary faces must be a faceCompactList')
+
+    # ascii faceList, e.g. 4(0 1 2 3), read as sizes followed by labels
+    count, begin = listStart(data, start)
+    last = count if last is None else last
+    end = listEnd(data, begin, count, labelType, 1, binary)
+    lineStart = skipLines(data, begin, first+1, end) if count else begin
+    lineEnd = end if last == count else skipLines(data, lineStart, last-first, end)
+    values = np.fromstring(bytes(data[lineStart:lineEnd]).translate(parentheses), int, sep=' ')
+    count = last - first
+    n = values[0] if len(values) else 0
+    if len(values) == count*(n+1) and (values[::n+1] == n).all():
+        return np.arange(count+1)*n, values.reshape(-1,n+1)[:,1:].ravel()
+    sizes = []
+    values = values.tolist()
+    i = 0
+    while i < len(values):
+        sizes.append(values[i])
+        i += values[i] + 1
+    sizes = np.array(sizes, dtype=int)
+    offsets = np.r_[0, np.cumsum(sizes)]
+    isLabel = np.ones(len(values), dtype=bool)
+    isLabel[offsets[:-1] + np.arange(len(sizes))] = False
+    return offsets, np.array(values, dtype=int)[isLabel]
+
+def readBoundary(path):
+    # Patches with name, type, nFaces and startFace
+    data = openFile(path)
+    header, start = readHeader(data)
+    patches = []
+    for name, entries in dictionaryPattern.findall(data, start):
+        patch = dict((k.decode(), v.strip().decode()) for k, v in entryPattern.findall(entries))
+        patch['name'] = name.decode()
+        patch['nFaces'] = int(patch.get('nFaces', 0))
+        patch['startFace'] = int(patch.get('startFace', 0))
+        patches.append(patch)
+    return patches
+
+def patchFaces(patches):
+    # Face ids of the patches, ordered by startFace
+    ranges = [np.arange(p['startFace'], p['startFace'] + p['nFaces']) for p in sorted(patches, key=lambda p: p['startFace'])]
+    return np.concatenate(ranges).astype(int) if ranges else np.empty(0, dtype=int)
+
+def selectFaces(offsets, labels, faceIds):
+    # Offsets and labels of the faces faceIds
+    sizes = np.diff(offsets)[faceIds]
+    selected = np.r_[0, np.cumsum(sizes)]
+    index = np.repeat(offsets[faceIds] - selected[:-1], sizes) + np.arange(selected[-1])
+    return selected, labels[index]
+
+def faceArray(offsets, labels):
+    # Faces as an (F,n) array if all faces have n points, otherwise as a
+    # list of arrays
+    sizes = np.diff(offsets)
+    if len(sizes) and (sizes == sizes[0]).all():
+        return labels.reshape(-1, sizes[0])
+    return np.split(labels, offsets[1:-1])
+
+def readBoundaryMesh(path, internalFaces=False):
+    # Boundary faces of the polyMesh in folder path, or all faces with
+    # internalFaces, and their points. Only the faces of the patches are read
+    # from faces, and only their points from points. Returns the points, the
+    # faces as offsets and labels of these points, and the patches.
+    patches = readBoundary(os.path.join(path, 'boundary'))
+    if internalFaces:
+        offsets, labels = readFaces(os.path.join(path, 'faces'))
+    else:
+        faceIds = patchFaces(patches)
+        first = faceIds.min() if len(faceIds) else 0
+        offsets, labels = readFaces(os.path.join(path, 'faces'), first, faceIds.max(initial=-1) + 1)
+        offsets, labels = selectFaces(offsets, labels, faceIds - first)
+    pointIds, labels = np.unique(labels, return_inverse=True)
+    points = readPoints(os.path.join(path, 'points'), pointIds)
+    return points, offsets, labels.reshape(-1), patches
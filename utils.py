@@ -1,249 +1,72 @@
 import bpy
 import numpy as np
 import bmesh
+import collections
+import hashlib
 from . import blender_utils
+from . import grading
+from .polyLines import snapVertices, polyLinePaths, polyLineString
 import importlib
 
-def edgeMapping(edge):
-    if edge["type"] == "Geometric MG":
-        return multiGrading(edge)
-    elif edge["type"] == "Geometric":
-        edge["ratio"] == edge["ratio"]
-        return edge
-
-def multiGrading(edge):
-    eps = 1e-6
-    grading1 = True
-    grading2 = True
-    x1,x2 = edge['x1'], edge['x2']
-    r1,r2 = edge['r1'], edge['r2']
-    N, L = edge['N'], edge['L']
-
-    def both(L,N,x1,x2,r1,r2,dx):
-        n1 = np.log(dx/x1) / np.log(r1) + 1
-        n2 = np.log(dx/x2) / np.log(r2) + 1
-        l1 = x1*(1-r1**n1)/(1-r1)
-        l2 = x2*(1-r2**n2)/(1-r2)
-        Lapprox = l1 + l2 + (N - n1 - n2-1)*dx
-        err = (L-Lapprox)
-        return err,(n1,n2,l1,l2)
-
-    def oneside(L,N,x,r,dx):
-        n = np.log(dx/x) / np.log(r) + 1
-        l = x*(1-r**n)/(1-r)
-        Lapprox = l + (N - n)*dx
-        err = (L-Lapprox)
-        return err,(n,l)
-
-    if abs(x1) < eps or (abs(r1) - 1) < eps:
-        grading1 = False
-    if abs(x2) < eps or (abs(r2) - 1) < eps:
-        grading2 = False
-
-    if not grading1 and not grading2:
-        edge["l1"], edge["l2"] = 0,0
-        edge["n1"], edge["n2"] = 0,0
-        edge["ratio1"], edge["ratio2"] = 1,1
-        edge["dL"], edge["nL"] = 1, N
-        return edge
-
-    elif grading1 and not grading2:
-        l1 = x1*(1-r1**N)/(1-r1)
-        if l1 < L:
-            n1 = np.log(1-l1/x1*(1-r1))/np.log(r1)
-            n1 += 1
-            dx = x1*r1**n1
-            edge["l1"], edge["l2"] = L,0
-            edge["n1"], edge["n2"] = n1,0
-            edge["ratio1"], edge["ratio2"] = dx/x1,1
-            edge["dL"], edge["nL"] = 0, 0
-            return edge
-        approx = oneside
-        x,r = x1,r1
-        dx = L/N #initial guess
-        parameters = [L,N,x,r,dx]
-    elif not grading1 and grading2:
-        l2 = x2*(1-r2**N)/(1-r2)
-        if l2 < L:
-            n2 = np.log(1-l2/x2*(1-r2))/np.log(r2)
-            n2 += 1
-            dx = x2*r2**n2
-            edge["l1"], edge["l2"] = 0,L
-            edge["n1"], edge["n2"] = 0,n2
-            edge["ratio1"], edge["ratio2"] = 1,dx/x2
-            edge["dL"], edge["nL"] = 0, 0
-            return edge
-        approx = oneside
-        x,r = x2,r2
-        dx = L/N
-        parameters = [L,N,x,r,dx]
-    else:
-        n1 = (np.log(x2/x1)+N*np.log(r2))/np.log(r1*r2)
-        n1 = int(n1+0.5)
-        n2 = N-n1-1
-        l1 = x1*((1-r1**n1)/(1-r1))
-        l2 = x2*((1-r2**n2)/(1-r2))
-        if (l1+l2) < L:
-            n1 = np.log((L*(1-r1)*(1-r2)-x1-x2+x1*r2+x2*r1)/(-2*x1+x1*r1+x1*r2))/np.log(r1)
-            n2 = np.log(x1/x2*r1**n1)/np.log(r2)
-            l1 = x1*((1-r1**n1)/(1-r1))
-            l2 = x2*((1-r2**n2)/(1-r2))
-            dx = x1*r1**n1
-            n1 += 1
-            n2 += 1
-            edge["l1"], edge["l2"] = l1,l2
-            edge["n1"], edge["n2"] = n1,n2
-            edge["ratio1"], edge["ratio2"] = dx/x1, dx/x2
-            edge["dL"], edge["nL"] = 0, 0
-            return edge
-            # l2 = (x2-x1+L-L*r1)/(2-r2-r1)
-            # l1 = L - l2
-            # n1 = np.log(1-l1/x1*(1-r1))/np.log(r1)
-            # n2 = N-n1
-        approx = both
-        dx = L/N
-        parameters = [L,N,x1,x2,r1,r2,dx]
-
-
-    Lapprox = 0.0
-    err = 1.0
-    count = 0
-
-    err,pars=approx(*parameters)
-    dx_old = dx
-    err_old = err
-    dx = dx*1.2*1e-10 # small perturbation
-    parameters[-1] = dx
-    err,pars=approx(*parameters)
-
-    while abs(err)>1e-12 and count < 1000:
-        dx_temp = dx
-        derr = (err - err_old)/(dx - dx_old)
-        dx = dx - err/derr
-        dx_old = dx_temp
-        err_old = err
-        parameters[-1] = dx
-        err, out = approx(*parameters)
-        count = count+1
-
-    if grading1 and not grading2:
-        n1,l1 = out
-        ratio1 = dx/x1
-        n2,l2,ratio2 = 0,0,1
-    elif not grading1 and grading2:
-        n2,l2 = out
-        ratio2 = dx/x2
-        n1,l1,ratio1 = 0,0,1
-    else:
-        n1,n2,l1,l2 = out
-        ratio1 = dx/x1
-        ratio2 = dx/x2
-
-    if (dx < x1 and abs(x1) > eps) or (dx < x2 and abs(x2) > eps):
-        dx = x1
-        l1, l2 = 0,0
-        n1, n2 = 0,0
-        ratio1, ratio2 = 1, 1
-
-    dL = L-l1-l2
-    nL = N-n1-n2
-    dx = dL/nL
-    edge['l1'], edge['l2'] = l1, l2
-    edge['n1'], edge['n2'] = n1, n2
-    edge['ratio1'], edge['ratio2'] = ratio1, ratio2
-    edge['dL'], edge['nL'] = dL, nL
-    return edge
-
-def getNodes(x1,x2,r1,r2,L,dx):
-    n1 = np.log(dx/x1)/np.log(r1) + 1
-    n2 = np.log(dx/x1)/np.log(r1) + 1
-    l1 = x1*(1-r1**n1)/(1-r1)
-    l2 = x2*(1-r2**n2)/(1-r2)
-    if (l1+l2) > L:
-        n1 = np.log((L*(1-r1)*(1-r2)-x1-x2+x1*r2+x2*r1)/(-2*x1+x1*r1+x1*r2))/np.log(r1)
-        n1 = int(n1+0.5)+1
-        n2 = np.log(x1/x2*r1**n1)/np.log(r2)
-        n2 = int(n2+0.5)
-        l1 = x1*((1-r1**n1)/(1-r1))
-        l2 = x2*((1-r2**n2)/(1-r2))
-        dx = x1*r1**n1
-        return n1+n2
-    else:
-        return n1+n2+(L-l1-l2)/dx
-
 def edge(e0, e1):
     return [min(e0,e1), max(e0,e1)]
 
-def findFace(faces, vl):
-    for fid, f in enumerate(faces):
-        if vl[0] in f and vl[1] in f and vl[2] in f and vl[3] in f:
-            return fid, f
-    return -1, []
-
 
-# No comments. Just works.
 def getEdgeDirections(block_print_out, dependent_edges):
-    edgeDirections = [set() for i in dependent_edges]
+    # Direct the edges of each edge group consistently. The first block of a
+    # group sets the direction of its four edges in the group, and the
+    # direction is propagated breadth first to the blocks sharing these
+    # edges. Returns the directed edges of each group and the ids of the
+    # groups where two blocks disagree on the direction of an edge, e.g. an
+    # o-grid where the edges turn around. In these groups the edges keep the
+    # direction found first.
     positiveBlockEdges = [[(0,1),(3,2),(7,6),(4,5)],[(0,3),(1,2),(5,6),(4,7)],[(0,4),(1,5),(2,6),(3,7)]]
-    for i in range(1000):
-        ready = True
-        for ed, de in zip(edgeDirections,dependent_edges):
-            if not len(ed)==len(de):
-                ready = False
-        if ready:
-            break
-        for bid, vl in enumerate(block_print_out):
-            for es, edgeSet in enumerate(dependent_edges):
-                for direction in range(3):
-                    if edge(vl[positiveBlockEdges[direction][0][0]],vl[positiveBlockEdges[direction][0][1]]) in edgeSet:
-                        if not edgeDirections[es]:
-                            edgeDirections[es] = set([(vl[e[0]],vl[e[1]]) for e in positiveBlockEdges[direction]])
-                        else:
-                            simedges = edgeDirections[es].intersection([(vl[e[0]],vl[e[1]]) for e in positiveBlockEdges[direction]])
-                            if simedges:
-                                edgeDirections[es] |= set([(vl[e[0]],vl[e[1]]) for e in positiveBlockEdges[direction]])
-                            else:
-                                asimedges= set(edgeDirections[es]).intersection([(vl[e[1]],vl[e[0]]) for e in positiveBlockEdges[direction]])
-                                if asimedges:
-                                    edgeDirections[es] |= set([(vl[e[1]],vl[e[0]]) for e in positiveBlockEdges[direction]])
-
-    return edgeDirections
-
-def sortEdges(edges):
-    sorted=[]
-    # Find out if the edges form a loop
-    edges1D=np.ravel(edges)
-    occ=np.bincount(edges1D)
-    # This is a loop, let's just start sorting anywhere (from first element here)
-    if len(np.where(occ==1)[0])==0:
-        sorted.append(edges[0][0])
-    # This is not a loop, let's find the first or last element
-    else:
-        # Find a vertex which occurs only 1 and then it's place in 2D list
-        firstidx1D=np.where(edges1D==np.where(occ==1)[0][0])[0][0]
-        if firstidx1D % 2 == 0:
-            sorted.append(edges[int(firstidx1D/2)][0])
-        else:
-            sorted.append(edges[int((firstidx1D-1)/2)][1])
-    edgesTemp = []
-    vertids = []
-    for e in edges:
-        vertids.append(e[0])
-        vertids.append(e[1])
-    vertids = list(set(vertids))
-    vertid=sorted[0]
-    edgesTemp=edges[:]
-    for i in range(len(vertids)):
-        for eid, e in enumerate(edgesTemp):
-            if vertid in e:
-                if e[0] == vertid:
-                    sorted.append(e[1])
-                else:
-                    sorted.append(e[0])
-                edgesTemp.pop(eid)
-                vertid = sorted[-1]
-                break
-    return sorted
+    edge_group = dict()
+    for gid, edgeSet in enumerate(dependent_edges):
+        for e in edgeSet:
+            edge_group[tuple(e)] = gid
+
+    # Directed edges of the blocks in each group, in block order
+    group_blocks = [[] for i in dependent_edges]
+    for vl in block_print_out:
+        for direction in range(3):
+            edges = [(vl[e[0]],vl[e[1]]) for e in positiveBlockEdges[direction]]
+            gid = edge_group.get(tuple(edge(*edges[0])))
+            if gid is not None:
+                group_blocks[gid].append(edges)
+
+    edgeDirections = [set() for i in dependent_edges]
+    inconsistent = []
+    for gid, blocks in enumerate(group_blocks):
+        if not blocks:
+            continue
+        blocks_of_edge = dict()
+        for bid, edges in enumerate(blocks):
+            for e in edges:
+                blocks_of_edge.setdefault(tuple(edge(*e)), []).append((bid, e))
+        directed = dict()
+        flipped = [None]*len(blocks)
+        for start in range(len(blocks)):
+            if flipped[start] is not None:
+                continue
+            flipped[start] = False
+            queue = collections.deque([start])
+            while queue:
+                bid = queue.popleft()
+                for e in blocks[bid]:
+                    if flipped[bid]:
+                        e = (e[1],e[0])
+                    key = tuple(edge(*e))
+                    if key not in directed:
+                        directed[key] = e
+                    elif directed[key] != e and not gid in inconsistent:
+                        inconsistent.append(gid)
+                    for nbid, ne in blocks_of_edge[key]:
+                        if flipped[nbid] is None:
+                            flipped[nbid] = ne != e
+                            queue.append(nbid)
+        edgeDirections[gid] = set(directed.values())
+    return edgeDirections, inconsistent
 
 def obFromStructuredMesh(verts, dim, objName):
     context = bpy.context
@@ -316,84 +139,90 @@ def getBlockFaces(verts):
 # Utility functions
 # -----------------
 
-def collectEdges(bob, lengths):
+def blockingFromBMesh(bm):
+    # Vertex coordinates and edges of the blocking object as NumPy arrays,
+    # which is the input of blockBuilder.blockFinder
+    verts = np.array([v.co[:] for v in bm.verts], dtype=float).reshape(-1,3)
+    edges = np.array([(e.verts[0].index, e.verts[1].index) for e in bm.edges], dtype=int).reshape(-1,2)
+    return verts, edges
+
+def edgeLayers(bob):
+    # Edge vertex indices, vertex coordinates and the edge layers of the
+    # blocking object as arrays. Mesh attributes (Blender 2.91+) are read in
+    # bulk with foreach_get, otherwise the layers are read in one bmesh pass.
+    intNames = ('groupid', 'modtime', 'cells')
+    floatNames = ('x1', 'x2', 'r1', 'r2', 'ratio')
+    mesh = bob.data
+    layers = dict()
+    if hasattr(mesh, 'attributes'):
+        bob.update_from_editmode()
+        if all(name in mesh.attributes for name in intNames + floatNames):
+            n = len(mesh.edges)
+            edges = np.empty(2*n, dtype=np.int32)
+            mesh.edges.foreach_get('vertices', edges)
+            coords = np.empty(3*len(mesh.vertices), dtype=np.float32)
+            mesh.vertices.foreach_get('co', coords)
+            for name in intNames + floatNames:
+                values = np.empty(n, dtype=np.int32 if name in intNames else np.float32)
+                mesh.attributes[name].data.foreach_get('value', values)
+                layers[name] = values
+            return edges.reshape(-1,2).astype(int), coords.reshape(-1,3).astype(float), layers
+
+    bm = bmesh.from_edit_mesh(mesh)
+    bmLayers = [bm.edges.layers.int.get(name) for name in intNames] + \
+               [bm.edges.layers.float.get(name) for name in floatNames]
+    values = [(e.verts[0].index, e.verts[1].index) + tuple(e[l] for l in bmLayers) for e in bm.edges]
+    values = np.array(values, dtype=float).reshape(-1, 2+len(bmLayers))
+    for i, name in enumerate(intNames + floatNames):
+        layers[name] = values[:,i+2]
+    for name in intNames:
+        layers[name] = layers[name].astype(int)
+    coords = np.array([v.co[:] for v in bm.verts], dtype=float).reshape(-1,3)
+    return values[:,:2].astype(int), coords, layers
+
+def collectEdges(bob, lengths, cache=None):
     bob.select_set(True)
     bpy.context.view_layer.objects.active = bob
     bpy.ops.object.mode_set(mode='EDIT')
-    # snap_vertices = get_snap_vertices(bob)
-    bm = bmesh.from_edit_mesh(bob.data)
-    layers = bm.edges.layers
-    # snapIdl = layers.string.get('snapId')
-    block_edges = dict()
-
-    timel = layers.int.get('modtime')
-    groupl = layers.int.get('groupid')
-    x1l = layers.float.get('x1')
-    x2l = layers.float.get('x2')
-    r1l = layers.float.get('r1')
-    r2l = layers.float.get('r2')
-    cellsl = layers.int.get('cells')
-    ratiol = layers.float.get("ratio")
-
-    ncells = dict()
-    times = dict()
-    for e in bm.edges:
-        if e[groupl] not in ncells:
-            ncells[e[groupl]] = e[cellsl]
-            times[e[groupl]] = e[timel]
-        elif e[timel] > times[e[groupl]]:
-            ncells[e[groupl]] = e[cellsl]
-            times[e[groupl]] = e[timel]
-
+    edges, coords, layers = edgeLayers(bob)
+
+    # The cells of an edge group are set by its last modified edge
+    groupid = layers['groupid']
+    order = np.lexsort((np.arange(len(edges)), -layers['modtime'], groupid))
+    first = order[np.r_[True, groupid[order][1:] != groupid[order][:-1]]]
+    groups, inverse = np.unique(groupid, return_inverse=True)
+    ncells = layers['cells'][first][inverse]
+
+    L = np.linalg.norm(coords[edges[:,0]] - coords[edges[:,1]], axis=1)
+    if len(lengths) > 1:
+        polyLineLengths = dict(zip(map(tuple, lengths[0]), lengths[1]))
+        for i, ev in enumerate(map(tuple, edges.tolist())):
+            if ev in polyLineLengths:
+                L[i] = polyLineLengths[ev]
+    return grading.edgeGradingArray(bob.swiftBlock_MappingType, edges, layers['x1'], layers['x2'], \
+            layers['r1'], layers['r2'], ncells, layers['ratio'], L, cache)
+
+
+def snapEdges(ob, bm):
+    # World coordinates of the block vertices and the edges to snap to the
+    # geometry. Preview, Export and Set Cell Size snap the same edges, so
+    # that they share the polylines of getPolyLines.
+    matrix = ob.matrix_world.copy()
+    verts = [matrix @ v.co for v in bm.verts]
+    # do not write polylines for hidden edges
+    edges = []
     for e in bm.edges:
-        be = dict()
-        ev = list([e.verts[0].index,e.verts[1].index])
-        if ev in lengths[0]:
-            ind = lengths[0].index(ev)
-            L = lengths[1][ind]
-        else:
-            L = (e.verts[0].co-e.verts[1].co).length
-        be["type"] = bob.swiftBlock_MappingType
-        be["x1"] = e[x1l]
-        be["x2"] = e[x2l]
-        be["r1"] = e[r1l]
-        be["r2"] = e[r2l]
-        be["N"] = ncells[e[groupl]]
-        be["ratio"] = e[ratiol]
-        be["L"] = L
-        if not be["N"]:
-            be["N"] = 10
-        if not be["r1"]:
-            be["r1"] = 1.
-        if not be["r2"]:
-            be["r2"] = 1.
-        if not be["ratio"]:
-            be["ratio"] = 1
-        be = edgeMapping(be)
-        block_edges[(e.verts[1].index,e.verts[0].index)] = be
-        be = dict(be)
-        be["x1"],be["x2"] = be["x2"],be["x1"]
-        be["r1"],be["r2"] = be["r2"],be["r1"]
-        be["ratio"] = 1./be["ratio"]
-        be = edgeMapping(be)
-
-        block_edges[(e.verts[0].index,e.verts[1].index)] = be
-    return block_edges
-
+        if not e.hide:
+            edges.append((e.verts[0].index, e.verts[1].index))
+    return verts, edges
 
 # Build the mesh from already existing blocking
 def writeMesh(ob, folder = ''):
     if not ob.swiftBlock_blocks:
         bpy.ops.swift_block.build_blocking('INVOKE_DEFAULT')
 
-    verts = list(blender_utils.vertices_from_mesh(ob))
     bm = bmesh.from_edit_mesh(ob.data)
-
-    # do not write polylines for hidden edges
-    edges = []
-    for e in bm.edges:
-        if not e.hide:
-            edges.append((e.verts[0].index, e.verts[1].index))
+    verts, edges = snapEdges(ob, bm)
 
     bpy.ops.object.mode_set(mode='OBJECT')
 
@@ -419,7 +248,10 @@ def writeMesh(ob, folder = ''):
             else:
                 block_names.append('')
 
-    edgeInfo = collectEdges(ob,lengths)
+    # Gradings solved in previous runs are stored on the object
+    gradingCache = grading.GradingCache(ob.swiftBlock_gradingCache)
+    edgeInfo = collectEdges(ob,lengths,gradingCache)
+    ob.swiftBlock_gradingCache = gradingCache.dumps()
 
     bm = bmesh.from_edit_mesh(ob.data)
     detemp = []
@@ -477,7 +309,7 @@ def writeMesh(ob, folder = ''):
         from . import blockMeshMG
         importlib.reload(blockMeshMG)
         if folder:
-            mesh = blockMeshMG.PreviewMesh(folder)
+            mesh = blockMeshMG.PreviewMesh(folder, ob.swiftBlock_splitDict, ob.swiftBlock_compressDict)
         else:
             mesh = blockMeshMG.PreviewMesh()
         # projection_tris = writeProjectionObjects(project_verts,project_edges,project_faces, mesh.geomPath)
@@ -486,6 +318,10 @@ def writeMesh(ob, folder = ''):
             projections['geo'] = geos
 
         cells = mesh.writeBlockMeshDict(verts, 1, boundaries, polyLines, edgeInfo, block_names, blocks, block_edges, projections)
+        if mesh.writtenFiles:
+            print('Wrote {}'.format(', '.join(mesh.writtenFiles)))
+        else:
+            print('blockMeshDict files are up to date')
     ###############################################################
     elif ob.swiftBlock_Mesher == 'blockMeshBodyFit':
         from . import blockMeshBodyFit
@@ -497,7 +333,7 @@ def writeMesh(ob, folder = ''):
         writeProjectionObjects(ob, mesh.triSurfacePath, onlyFaces = True)
         cells = mesh.writeBlockMeshDict(verts, 1, boundaries, polyLines, edgeInfo, block_names, blocks, block_edges, projections, ob.swiftBlock_SearchLength)
     bpy.ops.wm.context_set_value(data_path="tool_settings.mesh_select_mode", value="(False,True,False)")
-    return mesh, cells
+    return mesh, cells, gradingCache
 
 
 def changeMesher(self, context):
@@ -649,133 +485,57 @@ def writeProjectionObjects(ob, path, onlyFaces = False):
     return objects
 
 
+# Polylines of the latest getPolyLines call of each blocking object, with the
+# hash of the block and snap object vertices and edges they were found for
+polyLinesCache = dict()
+
+def polyLinesKey(verts, edges, geo_verts, geo_edges):
+    # Hash of the coordinates and edges, changes if any of them changes
+    key = hashlib.sha1()
+    for a in (np.array(verts, dtype=float).reshape(-1,3), np.array(edges, dtype=int).reshape(-1,2), \
+              np.array(geo_verts, dtype=float).reshape(-1,3), np.array(geo_edges, dtype=int).reshape(-1,2)):
+        key.update(np.int64(len(a)).tobytes())
+        key.update(np.ascontiguousarray(a).tobytes())
+    return key.hexdigest()
+
 # Kalle's implementation
 def getPolyLines(verts, edges, bob):
+    geoobj = bpy.data.objects[bob.swiftBlock_EdgeSnapObject]
+    geo_verts = list(blender_utils.vertices_from_mesh(geoobj))
+    geo_edges = list(blender_utils.edges_from_mesh(geoobj))
+
+    # Snapping is skipped if neither the blocking nor the snap object changed
+    key = polyLinesKey(verts, edges, geo_verts, geo_edges)
+    cached = polyLinesCache.get(bob.name)
+    if cached and cached[0] == key:
+        print('Blocking and snap object have not changed, skipped snapping')
+        return cached[1]
+
     polyLinesPoints = []
-    polyLines = ''
+    polyLines = []
     polyLinesLengths = [[], []]
     tol = 1e-6
 
-    def isPointOnEdge(point, A, B):
-        eps = (((A - B).magnitude - (point-B).magnitude) - (A-point).magnitude)
-        return True if (abs(eps) < tol) else False
-
     # nosnap= [False for i in range(len(edges))]
     # for eid, e in enumerate(obj.data.edges):
         # nosnap[eid] = e.use_edge_sharp
 
-    bpy.ops.wm.context_set_value(data_path="tool_settings.mesh_select_mode", value="(True,False,False)")
-    geoobj = bpy.data.objects[bob.swiftBlock_EdgeSnapObject]
-    geo_verts = list(blender_utils.vertices_from_mesh(geoobj))
-    geo_edges = list(blender_utils.edges_from_mesh(geoobj))
-    geoobj.select_set(False) # avoid deletion
-
 # First go through all vertices in the block structure and find vertices snapped to edges
-# When found, add a vertex at that location to the polyLine object by splitting the edge
-# Create a new Blender object containing the newly inserted verts. Then use Blender's
-# shortest path algo to find polyLines.
-
-    for vid, v in enumerate(verts):
-        found = False
-        for gvid, gv in enumerate(geo_verts):
-            mag = (v-gv).magnitude
-            if mag < tol:
-                found = True
-                break   # We have found a vertex co-located, continue with next block vertex
-        if not found:
-            for geid, ge in enumerate(geo_edges):
-                if (isPointOnEdge(v, geo_verts[ge[0]], geo_verts[ge[1]])):
-                    geo_verts.append(v)
-                    geo_edges.append([geo_edges[geid][1],len(geo_verts)-1]) # Putting the vert on the edge, by splitting it in two.
-                    geo_edges[geid][1] = len(geo_verts)-1
-                    break # No more iteration, go to next block vertex
-
-    mesh_data = bpy.data.meshes.new("deleteme")
-    mesh_data.from_pydata(geo_verts, geo_edges, [])
-    mesh_data.update()
-    geoobj = bpy.data.objects.new('deleteme', mesh_data)
-    bpy.context.collection.objects.link(geoobj)
-    geo_verts = list(blender_utils.vertices_from_mesh(geoobj))
-    geo_edges = list(blender_utils.edges_from_mesh(geoobj))
-    bpy.context.view_layer.objects.active=geoobj
-
-# Now start the search over again on the new object with more verts
-    snapped_verts = {}
-    for vid, v in enumerate(verts):
-        for gvid, gv in enumerate(geo_verts):
-            mag = (v-gv).magnitude
-            if mag < tol:
-                snapped_verts[vid] = gvid
-                break   # We have found a vertex co-located, continue with next block vertex
-
-    bpy.ops.wm.context_set_value(data_path="tool_settings.mesh_select_mode", value="(True,False,False)")
-    for edid, ed in enumerate(edges):
-        if ed[0] in snapped_verts and ed[1] in snapped_verts:# and not nosnap[edid]:
-            geoobj.hide_set(False)
-            bpy.ops.object.mode_set(mode='EDIT')
-            bpy.ops.mesh.select_all(action='DESELECT')
-            bpy.ops.object.mode_set(mode='OBJECT')
-            geoobj.data.vertices[snapped_verts[ed[0]]].select=True
-            geoobj.data.vertices[snapped_verts[ed[1]]].select=True
-            bpy.ops.object.mode_set(mode='EDIT')
-            try:
-                bpy.ops.mesh.select_vertex_path(type='EDGE_LENGTH')
-            except:
-                bpy.ops.mesh.shortest_path_select()
-            bpy.ops.object.mode_set(mode='OBJECT')
-            bpy.ops.object.mode_set(mode='EDIT')
-            bpy.ops.mesh.duplicate()
-            bpy.ops.object.mode_set(mode='OBJECT')
-            bpy.ops.object.mode_set(mode='EDIT')
-            bpy.ops.mesh.separate(type='SELECTED')
-            bpy.ops.object.mode_set(mode='OBJECT')
-            polyLineobj = bpy.data.objects['deleteme.001']
-            if len(polyLineobj.data.vertices) > 2:
-                polyLineverts = list(blender_utils.vertices_from_mesh(polyLineobj))
-                polyLineedges = list(blender_utils.edges_from_mesh(polyLineobj))
-                for vid, v in enumerate(polyLineverts):
-                    mag = (v-verts[ed[0]]).magnitude
-                    if mag < tol:
-                        startVertex = vid
-                        break
-                polyLineStr, vectors, length = sortedVertices(polyLineverts,polyLineedges,startVertex)
-                polyLinesPoints.append([ed[0],ed[1],vectors])
-                polyLinesLengths[0].append([min(ed[0],ed[1]), max(ed[0],ed[1])]) # write out sorted
-                polyLinesLengths[1].append(length)
-                polyLine = 'polyLine {} {} ('.format(*ed)
-                polyLine += polyLineStr
-                polyLine += ')\n'
-                polyLines += polyLine
-
-            geoobj.select_set(False)
-            polyLineobj.select_set(True)
-            bpy.ops.object.delete()
-    geoobj.select_set(True)
-    bpy.ops.object.delete()
+# When found, add a vertex at that location by splitting the edge. The vertices and edges
+# near each block vertex are found with a spatial grid. Then the polyLines are the shortest
+# paths along the geometry edges between the snapped vertices.
+
+    geo_verts, geo_edges, snapped_verts = snapVertices(verts, geo_verts, geo_edges, tol)
+    snapped_edges = [ed for ed in edges if ed[0] in snapped_verts and ed[1] in snapped_verts]# and not nosnap[edid]
+    paths = polyLinePaths(geo_verts, geo_edges, [(snapped_verts[ed[0]], snapped_verts[ed[1]]) for ed in snapped_edges], \
+        bob.swiftBlock_SnapProcesses)
+    for ed, path in zip(snapped_edges, paths):
+        if path is not None and len(path) > 2:
+            vectors = geo_verts[path]
+            polyLineStr, length = polyLineString(vectors)
+            polyLinesPoints.append([ed[0],ed[1],vectors])
+            polyLinesLengths[0].append([min(ed[0],ed[1]), max(ed[0],ed[1])]) # write out sorted
+            polyLinesLengths[1].append(length)
+            polyLines.append('polyLine {} {} ({})\n'.format(ed[0], ed[1], polyLineStr))
+    polyLinesCache[bob.name] = (key, (polyLines, polyLinesPoints, polyLinesLengths))
     return polyLines, polyLinesPoints, polyLinesLengths
-
-def sortedVertices(verts,edges,startVert):
-    sorted = []
-    vectors = []
-    sorted.append(startVert)
-    vert = startVert
-    length = len(edges)+1
-    for i in range(len(verts)):
-        for eid, e in enumerate(edges):
-            if vert in e:
-                if e[0] == vert:
-                    sorted.append(e[1])
-                else:
-                    sorted.append(e[0])
-                edges.pop(eid)
-                vert = sorted[-1]
-                break
-
-    polyLine = ''
-    length = 0.
-    for vid, v in enumerate(sorted):
-        polyLine += '({} {} {})'.format(*verts[v])
-        vectors.append(verts[v])
-        if vid>=1:
-            length += (vectors[vid] - vectors[vid-1]).magnitude
-    return polyLine, vectors, length